@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Backfill: rebuild the booking_rollups collection from the bookings collection
+
+Streams bookings (only the fields the rollups need), accumulates daily and hourly
+buckets in memory and replaces the matching rollup documents. Run it once after
+deploying the rollups, or again to repair them; it is safe to re-run.
+
+Usage: python backfill_rollups.py [--from 2024-01-01] [--to 2024-12-31] [--dry-run]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import timedelta
+
+from pymongo import ReplaceOne
+
+from server import (
+    ROLLUP_GRANULARITIES, add_rollup_increments, close_mongo, connect_mongo, parse_datetime, rollup_id,
+    start_log_export, stop_log_export,
+)
+
+db = connect_mongo()
+
+logger = logging.getLogger("backfill_rollups")
+
+
+def rollup_document(granularity, bucket, increments):
+    """Turn accumulated dotted-path increments into a full rollup document"""
+    document = {"granularity": granularity, "bucket": bucket, "count": 0, "revenue": 0.0, "cells": {}}
+    for path, value in increments.items():
+        if path.startswith("cells."):
+            _, cell, field = path.split(".")
+            document["cells"].setdefault(cell, {})[field] = value
+        else:
+            document[path] = value
+    return document
+
+
+async def backfill(start, end, batch_size: int, dry_run: bool):
+    query = {}
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if end:
+            query["created_at"]["$lt"] = end
+
+    updates = {}
+    scanned = 0
+    projection = {"_id": 0, "created_at": 1, "site_id": 1, "status": 1, "total_price": 1}
+    async for booking in db.bookings.find(query, projection).batch_size(batch_size):
+        if not booking.get("created_at"):
+            continue
+        add_rollup_increments(updates, booking, booking.get("status", "pending"), 1)
+        scanned += 1
+
+    # Partial buckets at the edges of a --from/--to window would be overwritten with partial totals
+    if start or end:
+        for (granularity, bucket) in list(updates):
+            step = ROLLUP_GRANULARITIES[granularity]
+            if (start and bucket < start) or (end and bucket + step > end):
+                logger.warning("Skipping partial %s bucket %s; widen --from/--to to include it", granularity, bucket.isoformat())
+                del updates[(granularity, bucket)]
+
+    operations = [
+        ReplaceOne({"_id": rollup_id(granularity, bucket)}, rollup_document(granularity, bucket, increments), upsert=True)
+        for (granularity, bucket), increments in updates.items()
+    ]
+    logger.info("Scanned %s bookings into %s rollup documents", scanned, len(operations))
+    if dry_run:
+        return
+    for i in range(0, len(operations), batch_size):
+        await db.booking_rollups.bulk_write(operations[i:i + batch_size], ordered=False)
+    logger.info("Rollups written")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="start", help="ISO date or datetime (UTC), inclusive")
+    parser.add_argument("--to", dest="end", help="ISO date or datetime (UTC); a bare date is inclusive")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    start = parse_datetime(args.start) if args.start else None
+    end = parse_datetime(args.end) if args.end else None
+    if end and len(args.end) == 10:
+        end += timedelta(days=1)
+
+    start_log_export()
+    try:
+        await backfill(start, end, args.batch_size, args.dry_run)
+    finally:
+        close_mongo()
+        stop_log_export()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
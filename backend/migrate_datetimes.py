@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+One-off migration: convert datetime fields stored as ISO strings into native BSON dates
+
+Only the fields declared as datetimes on each model (see MONGO_CODECS in server.py) are
+touched. Safe to re-run; documents that are already migrated are not matched.
+
+Usage: python migrate_datetimes.py [--dry-run] [--batch-size N] [collection ...]
+"""
+
+import argparse
+import asyncio
+import logging
+
+from pymongo import UpdateOne
+
+from server import MONGO_CODECS, close_mongo, connect_mongo, parse_datetime, start_log_export, stop_log_export
+
+db = connect_mongo()
+
+logger = logging.getLogger("migrate_datetimes")
+
+
+async def migrate_collection(name: str, batch_size: int, dry_run: bool) -> int:
+    codec = MONGO_CODECS[name]
+    collection = db[name]
+    legacy = {"$or": [{field: {"$type": "string"}} for field in codec.datetime_fields]}
+    projection = {field: 1 for field in codec.datetime_fields}
+
+    migrated = 0
+    operations = []
+    async for document in collection.find(legacy, projection):
+        changes = {}
+        for field in codec.datetime_fields:
+            value = document.get(field)
+            if isinstance(value, str):
+                try:
+                    changes[field] = parse_datetime(value)
+                except ValueError:
+                    logger.warning("%s %s: cannot parse %s=%r, leaving as is", name, document['_id'], field, value)
+        if not changes:
+            continue
+        operations.append(UpdateOne({"_id": document["_id"]}, {"$set": changes}))
+        if len(operations) >= batch_size:
+            migrated += await flush(collection, operations, dry_run)
+            operations = []
+    if operations:
+        migrated += await flush(collection, operations, dry_run)
+
+    logger.info("%s: %s %s documents", name, 'would migrate' if dry_run else 'migrated', migrated)
+    return migrated
+
+
+async def flush(collection, operations, dry_run: bool) -> int:
+    if dry_run:
+        return len(operations)
+    result = await collection.bulk_write(operations, ordered=False)
+    return result.modified_count
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("collections", nargs="*", metavar="collection", help=f"default: {' '.join(MONGO_CODECS)}")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    unknown = [name for name in args.collections if name not in MONGO_CODECS]
+    if unknown:
+        parser.error(f"unknown collection(s): {', '.join(unknown)}")
+
+    start_log_export()
+    try:
+        for name in args.collections or MONGO_CODECS:
+            await migrate_collection(name, args.batch_size, args.dry_run)
+    finally:
+        close_mongo()
+        stop_log_export()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Rebuild the slot_occupancy collection from the bookings collection
+
+Sums the group sizes of every pending and confirmed booking per site, date and time
+and replaces the occupancy documents, dropping slots that no longer hold a booking.
+The API seeds the collection itself when it is empty; run this to repair it, for
+example after editing bookings directly in the database. It is safe to re-run.
+
+Usage: python rebuild_slot_occupancy.py
+"""
+
+import argparse
+import asyncio
+
+from server import close_mongo, connect_mongo, rebuild_slot_occupancy, start_log_export, stop_log_export
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    start_log_export()
+    connect_mongo()
+    try:
+        await rebuild_slot_occupancy()
+    finally:
+        close_mongo()
+        stop_log_export()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
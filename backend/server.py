@@ -1,34 +1,668 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import HTTPConnection
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import pymongo
+from pymongo import IndexModel, ReadPreference, ReplaceOne, ReturnDocument, UpdateOne, WriteConcern, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError, WriteError
+from abc import ABC, abstractmethod
+import asyncio
+import atexit
+import base64
+import binascii
+import bisect
+from collections import Counter, OrderedDict
+import contextlib
+from contextvars import Context, ContextVar
+import functools
+import gzip
+import hashlib
+import importlib
+import json
+import orjson
 import os
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import random
+import sys
+import threading
+import time
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import Any, List, Optional, Dict, Set, Tuple, Union, get_args, get_origin
 import uuid
-from datetime import datetime, timezone
-from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
+import zlib
+from datetime import datetime, timedelta, timezone
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# The Stripe integration (emergentintegrations, the stripe SDK and requests) is the slowest
+# part of the import graph, so it is imported on first use rather than with this module
+@functools.lru_cache(maxsize=None)
+def stripe_checkout_module():
+    return importlib.import_module("emergentintegrations.payments.stripe.checkout")
+
+@functools.lru_cache(maxsize=None)
+def stripe_sdk():
+    """The stripe SDK, or None when it is missing (it is installed alongside emergentintegrations)"""
+    try:
+        return importlib.import_module("stripe")
+    except ImportError:  # without it Stripe keeps its defaults
+        return None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Logging
+# Handlers only enqueue records; a QueueListener thread formats them and does the I/O,
+# so a slow disk or pipe never stalls the event loop. Pass values as logging arguments
+# rather than f-strings: the message is only built on that thread, and only if emitted.
+# Importing the module only installs the handlers; the lifespan handler (scripts call it
+# themselves) starts the listeners with start_log_export(), and records logged before that wait.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()  # json or text
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+REQUEST_ID_HEADER = "X-Request-ID"
+
+def parse_route_values(value: str) -> Dict[str, float]:
+    """Parse "GET /api/sites=0.1,POST /api/bookings=0.5" into {route: value}"""
+    values = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route, _, number = item.rpartition('=')
+        values[route.strip()] = float(number)
+    return values
+
+# Per "<METHOD> <route template>": the share of requests whose records below WARNING are kept
+LOG_SAMPLE_RATES = parse_route_values(os.environ.get('LOG_SAMPLE_RATES', ''))
+
+class RequestLogContext:
+    __slots__ = ("request_id", "scope", "sampled")
+
+    def __init__(self, request_id: str, scope: dict):
+        self.request_id = request_id
+        self.scope = scope
+        self.sampled: Optional[bool] = None
+
+    def keep(self) -> bool:
+        """Sample once per request, so a request's records are kept or dropped together"""
+        if self.sampled is None:
+            route = self.scope.get("route")
+            if route is None:
+                return True  # not routed yet
+            rate = LOG_SAMPLE_RATES.get(f"{self.scope['method']} {route.path}")
+            self.sampled = rate is None or random.random() < rate
+        return self.sampled
+
+request_log_context: ContextVar[Optional[RequestLogContext]] = ContextVar("request_log_context", default=None)
+
+class RequestContextFilter(logging.Filter):
+    """Runs in the caller's context: stamps the request id and applies sampling"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = request_log_context.get()
+        record.request_id = context.request_id if context is not None else None
+        if context is not None and record.levelno < logging.WARNING and LOG_SAMPLE_RATES:
+            return context.keep()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock QueueHandler formats here, on the caller's thread; leave it to the listener
+        return record
+
+log_listeners: List[QueueListener] = []
+
+def start_log_export():
+    """Start the listener threads that write queued log and trace records"""
+    for listener in log_listeners:
+        if listener._thread is None:
+            listener.start()
+
+def stop_log_export():
+    """Flush the queues and stop the listener threads; safe to call more than once"""
+    for listener in log_listeners:
+        if listener._thread is not None:
+            listener.stop()
+
+# Flush what is still queued when the process exits
+atexit.register(stop_log_export)
+
+def configure_logging() -> QueueListener:
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT))
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler], force=True)
+    log_listeners.append(listener)
+    return listener
+
+log_listener = configure_logging()
+
+class RequestContextMiddleware:
+    """Give every request an id (the client's X-Request-ID, or a new one) for its log records and response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = Headers(scope=scope).get(REQUEST_ID_HEADER)
+        if not request_id or len(request_id) > 128:
+            request_id = uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(REQUEST_ID_HEADER, request_id)
+            await send(message)
+
+        token = request_log_context.set(RequestLogContext(request_id, scope))
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_log_context.reset(token)
+
 # Initialize Stripe
 stripe_api_key = os.environ.get('STRIPE_API_KEY')
 if not stripe_api_key:
     logging.warning("STRIPE_API_KEY not found in environment variables")
 
+# Metrics
+# Prometheus text exposition without a client library. Each label set gets its child
+# object once; recording a sample is then a dict lookup, a bisect and two additions.
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metric_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterChild:
+    __slots__ = ("value", "lock")
+
+    def __init__(self, lock: threading.Lock):
+        self.value = 0
+        self.lock = lock
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets: Tuple[float, ...], lock: threading.Lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.lock = lock
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Metric(ABC):
+    """One metric family; labels() hands out the same child for the same label values"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        # Mongo commands are recorded from Motor's executor threads
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        metrics_registry.append(self)
+
+    @abstractmethod
+    def new_child(self):
+        """A child holding the samples of one label set"""
+
+    @abstractmethod
+    def render_child(self, values: Tuple[str, ...], child) -> List[str]:
+        """Exposition lines of one child"""
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self.new_child())
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def new_child(self) -> CounterChild:
+        return CounterChild(self._lock)
+
+    def render_child(self, values: Tuple[str, ...], child: CounterChild) -> List[str]:
+        return [f"{self.name}{metric_labels(self.label_names, values)} {child.value}"]
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+
+    def new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets, self._lock)
+
+    def render_child(self, values: Tuple[str, ...], child: HistogramChild) -> List[str]:
+        with self._lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{metric_labels(self.label_names, values, le)} {cumulative}")
+        labels = metric_labels(self.label_names, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+metrics_registry: List[Metric] = []
+http_request_duration = HistogramMetric(
+    "http_request_duration_seconds", "Request latency per route", ("method", "route"))
+http_responses = CounterMetric(
+    "http_responses_total", "Responses per route and status code", ("method", "route", "status"))
+mongo_command_duration = HistogramMetric(
+    "mongodb_command_duration_seconds", "Mongo round trips per collection and command", ("collection", "command"))
+mongo_command_failures = CounterMetric(
+    "mongodb_command_failures_total", "Failed Mongo commands per collection and command", ("collection", "command"))
+stripe_request_duration = HistogramMetric(
+    "stripe_request_duration_seconds", "Stripe call latency per operation and outcome", ("operation", "outcome"))
+booking_write_batch_size = HistogramMetric(
+    "booking_write_batch_size", "Bookings per insert_many of the write buffer", (),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+mongo_deadline_exceeded = CounterMetric(
+    "mongodb_deadline_exceeded_total", "Requests answered 503 because Mongo missed the route deadline", ("method", "route"))
+expiry_sweep_duration = HistogramMetric(
+    "expiry_sweep_duration_seconds", "Expiry sweep latency per step", ("step",))
+expiry_sweep_records = CounterMetric(
+    "expiry_sweep_records_total", "Records expired or archived by the expiry sweeper", ("step",))
+expiry_sweep_runs = CounterMetric(
+    "expiry_sweep_runs_total", "Expiry sweeps per outcome (done, partial, not_leader, failed)", ("outcome",))
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command Motor sends; runs on the driver's threads"""
+
+    def __init__(self):
+        # (connection, request id) -> (collection, command) of the commands in flight
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str]] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        collection = target if isinstance(target, str) else event.database_name
+        self._pending[(event.connection_id, event.request_id)] = (collection, event.command_name)
+
+    def succeeded(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            mongo_command_duration.labels(*labels).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            mongo_command_duration.labels(*labels).observe(event.duration_micros / 1e6)
+            mongo_command_failures.labels(*labels).inc()
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware timing each HTTP request under its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+            http_request_duration.labels(*labels).observe(time.perf_counter() - start)
+            http_responses.labels(*labels, str(status[0])).inc()
+
+def preallocate_route_metrics(routes):
+    """Create the latency children of every API route up front, so requests only look them up"""
+    for route in routes:
+        if isinstance(route, APIRoute):
+            for method in route.methods:
+                http_request_duration.labels(method, route.path)
+
+# Tracing
+# A trace per request holds spans timed with perf_counter; the active trace and span
+# travel in contextvars, so nested helpers and tasks they start attach to the right parent.
+# Traces go to TRACE_EXPORT ("stdout" or a file path, one JSON object per line) through a
+# QueueListener like the logs, and TRACE_SERVER_TIMING adds a Server-Timing header.
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT', '')
+TRACE_SERVER_TIMING = env_flag('TRACE_SERVER_TIMING')
+TRACING_ENABLED = bool(TRACE_EXPORT) or TRACE_SERVER_TIMING
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration", "attributes")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: dict):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.attributes = attributes
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def export(self, **fields) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            **fields,
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "spans": [
+                {"name": span.name, "span_id": span.span_id, "parent_id": span.parent_id,
+                 "start_ms": round((span.start - self.start) * 1000, 3),
+                 "duration_ms": round(span.duration * 1000, 3), **span.attributes}
+                for span in self.spans
+            ],
+        }
+
+    def server_timing(self) -> str:
+        """Total time per span name, e.g. 'mongo.bookings.find_one;dur=1.2, stripe.get_checkout_status;dur=48.0'"""
+        totals: Dict[str, List[float]] = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, [0.0, 0])
+            total[0] += span.duration
+            total[1] += 1
+        return ", ".join(
+            f'{name};dur={duration * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else "")
+            for name, (duration, count) in totals.items()
+        )
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span_id: ContextVar[Optional[str]] = ContextVar("current_span_id", default=None)
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes):
+    """Time the enclosed block as a span of the current trace; a no-op outside a traced request"""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    span = Span(name, current_span_id.get(), attributes)
+    token = current_span_id.set(span.span_id)
+    try:
+        yield span
+    finally:
+        span.duration = time.perf_counter() - span.start
+        current_span_id.reset(token)
+        trace.spans.append(span)
+
+async def traced(name: str, awaitable):
+    """Await inside a span: `await traced("mongo.bookings.find_one", db.bookings.find_one(...))`"""
+    if current_trace.get() is None:
+        return await awaitable
+    with trace_span(name):
+        return await awaitable
+
+class TraceFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, default=str)
+
+def configure_trace_export() -> Optional[logging.Logger]:
+    if not TRACE_EXPORT:
+        return None
+    trace_queue = queue.SimpleQueue()
+    # delay: the file is opened by the first record, not at import
+    output = logging.StreamHandler(sys.stdout) if TRACE_EXPORT == "stdout" else logging.FileHandler(TRACE_EXPORT, delay=True)
+    output.setFormatter(TraceFormatter())
+    log_listeners.append(QueueListener(trace_queue, output))
+    trace_logger = logging.getLogger("server.traces")
+    trace_logger.addHandler(DeferredQueueHandler(trace_queue))
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    return trace_logger
+
+trace_logger = configure_trace_export()
+
+def trace_id_from_headers(headers: Headers) -> str:
+    """Continue a W3C traceparent trace id when the caller sends one"""
+    parts = headers.get("traceparent", "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32:
+        return parts[1]
+    return uuid.uuid4().hex
+
+class TracingMiddleware:
+    """Trace each HTTP request when tracing is enabled; exports it and adds Server-Timing if configured"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            return await self.app(scope, receive, send)
+        trace = Trace(trace_id_from_headers(Headers(scope=scope)))
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if TRACE_SERVER_TIMING:
+                    app_time = f"app;dur={(time.perf_counter() - trace.start) * 1000:.1f}"
+                    spans = trace.server_timing()
+                    MutableHeaders(scope=message).append("Server-Timing", f"{spans}, {app_time}" if spans else app_time)
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_trace.reset(token)
+            if trace_logger is not None:
+                route = scope.get("route")
+                context = request_log_context.get()
+                trace_logger.info(trace.export(
+                    request_id=context.request_id if context is not None else None,
+                    method=scope["method"],
+                    route=route.path if route is not None else scope["path"],
+                    status=status[0]
+                ))
+
 # MongoDB connection
+# The client is created by the lifespan handler (scripts call connect_mongo themselves),
+# so importing this module opens no sockets and starts no monitor threads
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '0'))
+# How long a request may wait for a free pooled connection; 0 waits as long as its deadline allows
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '0'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000'))
+# Analytics gets its own, smaller pool so slow aggregations cannot starve catalog and booking
+# requests of connections; 0 shares the main pool
+ANALYTICS_MAX_POOL_SIZE = int(os.environ.get('ANALYTICS_MAX_POOL_SIZE', '10'))
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+# Catalog and analytics tolerate replication lag; everything else reads the primary
+CATALOG_READ_PREFERENCE = READ_PREFERENCES[os.environ.get('CATALOG_READ_PREFERENCE', 'secondaryPreferred')]
+ANALYTICS_READ_PREFERENCE = READ_PREFERENCES[os.environ.get('ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')]
+
+mongo_command_metrics = MongoCommandMetrics()
+client: Optional[AsyncIOMotorClient] = None
+analytics_client: Optional[AsyncIOMotorClient] = None
+db = None
+catalog_db = None
+analytics_db = None
+
+def mongo_client(max_pool_size: int) -> AsyncIOMotorClient:
+    options = {
+        "maxPoolSize": max_pool_size,
+        "minPoolSize": min(MONGO_MIN_POOL_SIZE, max_pool_size),
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if MONGO_MAX_IDLE_TIME_MS > 0:
+        options["maxIdleTimeMS"] = MONGO_MAX_IDLE_TIME_MS
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS > 0:
+        options["waitQueueTimeoutMS"] = MONGO_WAIT_QUEUE_TIMEOUT_MS
+    return AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[mongo_command_metrics], **options)
+
+def with_read_preference(database, read_preference):
+    if read_preference == ReadPreference.PRIMARY:
+        return database
+    return database.with_options(read_preference=read_preference)
+
+def connect_mongo():
+    """Create the clients on first call; returns the database"""
+    global client, analytics_client, db, catalog_db, analytics_db
+    if client is None:
+        client = mongo_client(MONGO_MAX_POOL_SIZE)
+        db = client[os.environ['DB_NAME']]
+        catalog_db = with_read_preference(db, CATALOG_READ_PREFERENCE)
+        if ANALYTICS_MAX_POOL_SIZE > 0:
+            analytics_client = mongo_client(ANALYTICS_MAX_POOL_SIZE)
+            analytics_db = with_read_preference(analytics_client[os.environ['DB_NAME']], ANALYTICS_READ_PREFERENCE)
+        else:
+            analytics_db = with_read_preference(db, ANALYTICS_READ_PREFERENCE)
+    return db
+
+def close_mongo():
+    global client, analytics_client, db, catalog_db, analytics_db
+    if analytics_client is not None:
+        analytics_client.close()
+        analytics_client = None
+    if client is not None:
+        client.close()
+        client = None
+        db = catalog_db = analytics_db = None
+
+# Mongo deadlines
+# Every Mongo operation of an API request shares one deadline (server selection, waiting for a
+# pooled connection and maxTimeMS), so slow requests fail fast with 503 instead of piling up.
+# Routes that wait on Stripe before writing get no deadline; streamed bodies run after it ends.
+MONGO_REQUEST_TIMEOUT = float(os.environ.get('MONGO_REQUEST_TIMEOUT', '5'))
+MONGO_ROUTE_TIMEOUTS = {
+    "POST /api/bookings/bulk": 30.0,
+    "PATCH /api/bookings/status": 60.0,
+    "POST /api/payments/checkout/session": 0.0,
+    "GET /api/payments/checkout/status/{session_id}": 0.0,
+    "POST /api/analytics/bookings/reconcile": 0.0,
+    **parse_route_values(os.environ.get('MONGO_ROUTE_TIMEOUTS', '')),
+}
+
+def mongo_timeout_error(exc: BaseException) -> Optional[PyMongoError]:
+    """The Mongo timeout behind exc, including one a handler already turned into a 500"""
+    if isinstance(exc, HTTPException) and exc.status_code == 500:
+        exc = exc.__context__
+    return exc if isinstance(exc, PyMongoError) and exc.timeout else None
+
+async def mongo_deadline(connection: HTTPConnection):
+    """Router dependency: run the request's Mongo operations under its route's deadline"""
+    if connection.scope["type"] != "http":
+        yield  # websockets are long-lived
+        return
+    method, route = connection.scope["method"], connection.scope["route"].path
+    seconds = MONGO_ROUTE_TIMEOUTS.get(f"{method} {route}", MONGO_REQUEST_TIMEOUT)
+    if seconds <= 0:
+        yield
+        return
+    try:
+        with pymongo.timeout(seconds):
+            yield
+    except Exception as e:
+        error = mongo_timeout_error(e)
+        if error is None:
+            raise
+        mongo_deadline_exceeded.labels(method, route).inc()
+        logging.warning("%s %s missed its %.1fs Mongo deadline: %s", method, route, seconds, error)
+        raise HTTPException(status_code=503, detail="Database busy, please retry", headers={"Retry-After": "1"})
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_log_export()
+    try:
+        await startup_event()
+        try:
+            yield
+        finally:
+            await shutdown_event()
+    finally:
+        stop_log_export()
 
 # Create the main app without a prefix
-app = FastAPI(title="Madinah Ziyarat API", version="1.0.0")
+# orjson encodes datetime and UUID values natively and is several times faster than json
+app = FastAPI(title="Madinah Ziyarat API", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", dependencies=[Depends(mongo_deadline)])
 
 # Pydantic Models
 class HistoricalSite(BaseModel):
@@ -102,23 +736,1948 @@ class PaymentRequest(BaseModel):
     success_url: str
     cancel_url: str
 
-# Helper function to convert datetime objects for MongoDB storage
-def prepare_for_mongo(data):
-    if isinstance(data, dict):
-        for key, value in data.items():
+# Same shapes as emergentintegrations' checkout responses, declared here so routes can
+# use them as response models without importing the Stripe integration
+class CheckoutSessionResponse(BaseModel):
+    url: str
+    session_id: str
+
+class CheckoutStatusResponse(BaseModel):
+    status: str
+    payment_status: str
+    amount_total: int
+    currency: str
+    metadata: Dict[str, str] = {}
+
+class BulkBookingItemResult(BaseModel):
+    index: int
+    status: str  # created, invalid, failed
+    id: Optional[str] = None
+    errors: Optional[List[Dict[str, Any]]] = None
+
+class BulkBookingResponse(BaseModel):
+    received: int
+    created: int
+    invalid: int
+    failed: int
+    results: List[BulkBookingItemResult]
+
+class BookingStatusFilter(BaseModel):
+    status: Optional[str] = None  # current status
+    site_id: Optional[int] = None
+    created_before: Optional[datetime] = None
+    older_than_hours: Optional[float] = Field(None, gt=0)
+
+class BookingStatusBulkUpdate(BaseModel):
+    status: str
+    ids: Optional[List[str]] = None
+    filter: Optional[BookingStatusFilter] = None
+
+class SiteCapacityUpdate(BaseModel):
+    slot_capacity: int = Field(ge=0)  # people per time slot
+    times: Optional[List[str]] = None  # bookable times, defaults to SLOT_TIMES
+
+class SiteCapacity(SiteCapacityUpdate):
+    site_id: int
+
+class SlotAvailability(BaseModel):
+    date: str
+    time: str
+    capacity: int
+    booked: int
+    available: int
+
+class SiteAvailability(BaseModel):
+    site_id: int
+    slot_capacity: int
+    slots: List[SlotAvailability]
+
+# Schema-driven Mongo codecs
+def is_datetime_annotation(annotation) -> bool:
+    """True for datetime and Optional[datetime] field annotations"""
+    if annotation is datetime:
+        return True
+    if get_origin(annotation) is Union:
+        return any(arg is datetime for arg in get_args(annotation))
+    return False
+
+def parse_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+class MongoCodec:
+    """Converts only a model's datetime fields between Python values and native BSON dates"""
+
+    def __init__(self, model, extra_datetime_fields: Tuple[str, ...] = ()):
+        self.model = model
+        self.model_fields = tuple(
+            name for name, field in model.model_fields.items() if is_datetime_annotation(field.annotation)
+        )
+        # Datetime fields written by updates that are not part of the model itself
+        self.datetime_fields = self.model_fields + tuple(extra_datetime_fields)
+
+    def encode(self, instance) -> dict:
+        """Model instance to a Mongo document; datetimes stay datetimes and are stored as BSON dates"""
+        document = instance.dict()
+        for name in self.model_fields:
+            value = document.get(name)
+            if value is not None and value.tzinfo is None:
+                document[name] = value.replace(tzinfo=timezone.utc)
+        return document
+
+    def decode(self, document: dict) -> dict:
+        """Mongo document to model kwargs, touching only the datetime fields"""
+        for name in self.model_fields:
+            value = document.get(name)
+            if value is None:
+                continue
             if isinstance(value, datetime):
-                data[key] = value.isoformat()
-    return data
+                if value.tzinfo is None:
+                    document[name] = value.replace(tzinfo=timezone.utc)
+            elif isinstance(value, str):
+                # Legacy ISO string written before migrate_datetimes.py was run
+                document[name] = parse_datetime(value)
+        return document
+
+    def load(self, document: dict):
+        return self.model(**self.decode(document))
+
+    def dump(self, document: dict) -> dict:
+        """Mongo document, possibly partial, to JSON values in the same format as a serialized model"""
+        document = self.decode(document)
+        fields = {name for name in document if name in self.model.model_fields}
+        # model_construct skips validation, which a partial document would fail
+        return self.model.model_construct(**document).model_dump(mode="json", include=fields)
+
+site_codec = MongoCodec(HistoricalSite)
+booking_codec = MongoCodec(Booking, extra_datetime_fields=("updated_at",))
+user_codec = MongoCodec(User)
+payment_transaction_codec = MongoCodec(PaymentTransaction)
+
+# Collection name -> codec, used by migrate_datetimes.py
+MONGO_CODECS = {
+    "historical_sites": site_codec,
+    "bookings": booking_codec,
+    "users": user_codec,
+    "payment_transactions": payment_transaction_codec,
+}
+
+# Catalog cache
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '300'))
+CATALOG_CHANGE_STREAM = env_flag('CATALOG_CHANGE_STREAM')
+# Serve the catalog as bytes encoded once per version instead of re-encoding per request
+CATALOG_PRESERIALIZED = env_flag('CATALOG_PRESERIALIZED', True)
+
+class CatalogSnapshot:
+    """Validated copy of the historical sites catalog, shared by all requests until it expires"""
+    __slots__ = ("version", "sites", "by_id", "payload", "body", "etag", "headers", "encoded", "expires_at")
+
+    def __init__(self, sites: List[HistoricalSite], expires_at: float):
+        self.version = 0
+        self.sites = sites
+        self.by_id = {site.id: site for site in sites}
+        self.payload = jsonable_encoder(sites)
+        self.body = orjson.dumps(self.payload)
+        # Weak, because the same validator covers the identity, gzip and br variants
+        self.etag = f'W/"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.headers = {"ETag": self.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        self.encoded = {"identity": (self.body, self.headers)}
+        if CATALOG_PRESERIALIZED:
+            self.encoded["gzip"] = (
+                gzip.compress(self.body, compresslevel=9, mtime=0),
+                {**self.headers, "Content-Encoding": "gzip"}
+            )
+            if brotli is not None:
+                self.encoded["br"] = (
+                    brotli.compress(self.body, quality=11),
+                    {**self.headers, "Content-Encoding": "br"}
+                )
+        self.expires_at = expires_at
+
+class CatalogCache:
+    """Versioned in-memory catalog with a TTL and optional change-stream invalidation"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def _fresh(self) -> Optional[CatalogSnapshot]:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < snapshot.expires_at:
+            return snapshot
+        return None
+
+    async def get(self) -> CatalogSnapshot:
+        """Return the current snapshot, reloading it from Mongo at most once per expiry"""
+        snapshot = self._fresh()
+        if snapshot is not None:
+            return snapshot
+        async with self._lock:
+            snapshot = self._fresh()
+            if snapshot is not None:
+                return snapshot
+            return await self._reload()
+
+    async def _reload(self) -> CatalogSnapshot:
+        sites = await catalog_db.historical_sites.find().to_list(length=None)
+        snapshot = CatalogSnapshot(
+            [site_codec.load(site) for site in sites],
+            time.monotonic() + self.ttl
+        )
+        current = self._snapshot
+        if current is not None and current.etag == snapshot.etag:
+            snapshot.version = current.version
+        else:
+            self.version += 1
+            snapshot.version = self.version
+            logging.info("Catalog cache loaded version %s (%s sites)", snapshot.version, len(snapshot.sites))
+        self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        """Force the next read to reload the catalog"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.expires_at = 0.0
+
+    async def _watch(self):
+        while True:
+            try:
+                async with db.historical_sites.watch() as stream:
+                    # Anything written between the last load and opening the stream
+                    self.invalidate()
+                    async for _ in stream:
+                        self.invalidate()
+            except OperationFailure as e:
+                logging.warning("Catalog change stream unavailable, relying on TTL only: %s", e)
+                return
+            except PyMongoError as e:
+                logging.warning("Catalog change stream interrupted, reconnecting: %s", e)
+                self.invalidate()
+                await asyncio.sleep(5)
+
+    def start_watching(self):
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of If-None-Match against our ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+# Server preference when the client weights encodings equally
+ENCODING_PREFERENCE = ("br", "gzip", "identity")
+
+@functools.lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding: str, available: tuple) -> str:
+    """Pick the best content-coding from an Accept-Encoding header"""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+
+    def quality(encoding: str) -> float:
+        if encoding in weights:
+            return weights[encoding]
+        # identity is acceptable unless explicitly refused; other codings only if listed
+        return weights.get("*", 1.0 if encoding == "identity" else 0.0)
+
+    candidates = [encoding for encoding in ENCODING_PREFERENCE if encoding in available]
+    best = max(candidates, key=lambda encoding: (quality(encoding), -ENCODING_PREFERENCE.index(encoding)))
+    return best if quality(best) > 0 else "identity"
+
+def catalog_response(request: Request, catalog: CatalogSnapshot) -> Response:
+    """Answer a catalog read from the snapshot without validating or encoding anything"""
+    if etag_matches(request, catalog.etag):
+        return Response(status_code=304, headers=catalog.headers)
+    if not CATALOG_PRESERIALIZED:
+        return ORJSONResponse(content=catalog.payload, headers=catalog.headers)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), tuple(catalog.encoded))
+    body, headers = catalog.encoded[encoding]
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Response compression
+# Negotiated br/gzip for API responses of at least COMPRESSION_MIN_SIZE bytes. Responses that
+# already have a Content-Encoding (the pre-compressed catalog) pass through untouched, and
+# streamed bodies are flushed chunk by chunk so NDJSON exports keep flowing.
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+COMPRESSION_ENCODINGS = ("br", "gzip", "identity") if brotli is not None else ("gzip", "identity")
+# Server-sent events must reach the client event by event; media is already compressed
+UNCOMPRESSED_MEDIA_TYPES = ("text/event-stream", "image/", "audio/", "video/")
+
+class StreamCompressor:
+    """Incremental br or gzip encoder; every call returns the bytes that can be sent so far"""
+    __slots__ = ("encoding", "_compressor")
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+    """Compress response bodies with the best encoding the client accepts"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""), COMPRESSION_ENCODINGS)
+        if encoding == "identity":
+            return await self.app(scope, receive, send)
+        start_message = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether compressing is worth it
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                headers = MutableHeaders(scope=start)
+                if "content-encoding" in headers or headers.get("content-type", "").startswith(UNCOMPRESSED_MEDIA_TYPES):
+                    await send(start)
+                    return await send(message)
+                vary = headers.get("vary", "")
+                if "accept-encoding" not in vary.lower():
+                    headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    return await send(message)
+                compressor = StreamCompressor(encoding)
+                headers["Content-Encoding"] = encoding
+                del headers["content-length"]
+                if not more_body:
+                    body = compressor.compress(body, final=True)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": body})
+                await send(start)
+            if compressor is None:
+                return await send(message)
+            await send({"type": "http.response.body", "body": compressor.compress(body, final=not more_body),
+                        "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+# Booking pagination
+BOOKING_PAGE_SIZE = 100
+BOOKING_MAX_PAGE_SIZE = 1000
+BOOKING_EXPORT_BATCH_SIZE = int(os.environ.get('BOOKING_EXPORT_BATCH_SIZE', '500'))
+# Newest first, with id breaking ties between bookings created in the same millisecond
+BOOKING_SORT = [("created_at", -1), ("id", -1)]
+
+def encode_booking_cursor(booking: dict) -> str:
+    """Opaque keyset cursor pointing just after the given booking"""
+    created_at = booking["created_at"]
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = json.dumps([created_at, booking["id"]], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_booking_cursor(cursor: str) -> dict:
+    """Turn a cursor back into a filter matching everything after it in BOOKING_SORT order"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        decoded = json.loads(raw)
+        # Valid JSON of another shape ([1, "x"], {"a": 1, "b": 2}) is as invalid as garbage
+        if not (isinstance(decoded, list) and len(decoded) == 2 and all(isinstance(value, str) for value in decoded)):
+            raise ValueError("cursor is not [created_at, id]")
+        created_at, booking_id = decoded
+        created_at = parse_datetime(created_at)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": booking_id}},
+    ]}
+
+def booking_projection(fields: Optional[str]) -> Optional[dict]:
+    """Mongo projection for a comma-separated field list; id and created_at are always kept for the cursor"""
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in Booking.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown booking fields: {', '.join(unknown)}")
+    projection = {"_id": 0, "id": 1, "created_at": 1}
+    projection.update({field: 1 for field in requested})
+    return projection
+
+def booking_status_filter_query(status_filter: BookingStatusFilter, status: str) -> dict:
+    """Mongo query for a bulk status change filter; at least one condition is required"""
+    query = {}
+    if status_filter.status is not None:
+        if status_filter.status not in transition_sources(status):
+            raise HTTPException(status_code=400, detail=f"Cannot change {status_filter.status} bookings to {status}")
+        query["status"] = status_filter.status
+    if status_filter.site_id is not None:
+        query["site_id"] = status_filter.site_id
+    created_before = status_filter.created_before
+    if created_before is not None and created_before.tzinfo is None:
+        created_before = created_before.replace(tzinfo=timezone.utc)
+    if status_filter.older_than_hours is not None:
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=status_filter.older_than_hours)
+        created_before = min(created_before, cutoff) if created_before else cutoff
+    if created_before is not None:
+        query["created_at"] = {"$lt": created_before}
+    if not query:
+        raise HTTPException(status_code=400, detail="The filter needs at least one condition")
+    return query
+
+def booking_query(user_email: Optional[str], cursor: Optional[str] = None) -> dict:
+    query = {}
+    if user_email:
+        query["email"] = user_email
+    if cursor:
+        query.update(decode_booking_cursor(cursor))
+    return query
+
+# Bulk booking ingestion
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '10000'))
+BULK_INSERT_CHUNK_SIZE = int(os.environ.get('BULK_INSERT_CHUNK_SIZE', '500'))
+
+async def read_bulk_items(request: Request) -> List[Any]:
+    """Parse a JSON array or NDJSON body; malformed NDJSON lines become ValueError items"""
+    body = await request.body()
+    content_type = request.headers.get("content-type", "").lower()
+    if "ndjson" in content_type or "jsonl" in content_type:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(ValueError(f"Invalid JSON: {e}"))
+    else:
+        try:
+            items = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} bookings per request")
+    return items
+
+async def insert_booking_chunk(chunk: List[Tuple[int, dict]], results: List[BulkBookingItemResult]):
+    """Unordered insert_many of one chunk; only the documents Mongo rejected are marked failed"""
+    try:
+        await db.bookings.insert_many([document for _, document in chunk], ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            index, _ = chunk[write_error["index"]]
+            results[index].status = "failed"
+            results[index].errors = [{"msg": write_error.get("errmsg", "Write failed")}]
+    except PyMongoError as e:
+        logging.error("Error inserting booking chunk: %s", e)
+        for index, _ in chunk:
+            results[index].status = "failed"
+            results[index].errors = [{"msg": "Write failed"}]
+
+# Slot capacity
+# slot_occupancy holds one document per booked time slot:
+# {_id: "<site_id>|<date>|<time>", site_id, date, time, booked}
+# where booked is the group_size sum of the slot's pending and confirmed bookings.
+# Seats are taken with a conditional $inc, so concurrent bookings cannot overfill a slot.
+SLOT_DEFAULT_CAPACITY = int(os.environ.get('SLOT_DEFAULT_CAPACITY', '40'))
+SLOT_TIMES = tuple(os.environ.get('SLOT_TIMES', '06:00,08:00,10:00,12:00,14:00,16:00').split(','))
+SITE_CAPACITY_CACHE_TTL = float(os.environ.get('SITE_CAPACITY_CACHE_TTL', '60'))
+AVAILABILITY_DEFAULT_DAYS = 30
+AVAILABILITY_MAX_DAYS = 92
+# site_id -> (loaded at, capacity)
+site_capacity_cache: Dict[int, Tuple[float, SiteCapacity]] = {}
+
+def slot_id(site_id: int, date: str, slot_time: str) -> str:
+    return f"{site_id}|{date}|{slot_time}"
+
+async def get_site_capacity(site_id: int) -> SiteCapacity:
+    cached = site_capacity_cache.get(site_id)
+    if cached and time.monotonic() - cached[0] < SITE_CAPACITY_CACHE_TTL:
+        return cached[1]
+    document = await db.site_capacity.find_one({"site_id": site_id}, {"_id": 0})
+    capacity = SiteCapacity(**document) if document else SiteCapacity(site_id=site_id, slot_capacity=SLOT_DEFAULT_CAPACITY)
+    site_capacity_cache[site_id] = (time.monotonic(), capacity)
+    return capacity
+
+async def reserve_seats(site_id: int, date: str, slot_time: str, seats: int, force: bool = False) -> bool:
+    """Take `seats` in a slot if they fit its capacity; force takes them regardless"""
+    update = {"$inc": {"booked": seats}, "$setOnInsert": {"site_id": site_id, "date": date, "time": slot_time}}
+    query = {"_id": slot_id(site_id, date, slot_time)}
+    if force:
+        await db.slot_occupancy.update_one(query, update, upsert=True)
+        return True
+    capacity = (await get_site_capacity(site_id)).slot_capacity
+    if seats > capacity:
+        return False
+    query["booked"] = {"$lte": capacity - seats}
+    try:
+        await db.slot_occupancy.update_one(query, update, upsert=True)
+        return True
+    except DuplicateKeyError:
+        # Either the slot is full, or another booking created its document first
+        result = await db.slot_occupancy.update_one(query, update)
+        return result.modified_count == 1
+
+async def release_seats(site_id: int, date: str, slot_time: str, seats: int):
+    try:
+        await db.slot_occupancy.update_one({"_id": slot_id(site_id, date, slot_time)}, {"$inc": {"booked": -seats}})
+    except PyMongoError as e:
+        # Leaves the slot looking fuller than it is until rebuild_slot_occupancy.py runs
+        logging.error("Error releasing seats for %s: %s", slot_id(site_id, date, slot_time), e)
+
+async def move_slot_seats(booking: dict, status: str, force: bool = True) -> bool:
+    """Take or give back a booking's seats when it leaves or re-enters the cancelled status
+
+    `booking` holds its previous state. Returns False when seats were needed but the slot is full.
+    """
+    if (booking.get("status") == "cancelled") == (status == "cancelled") or "group_size" not in booking:
+        return True
+    slot = (booking["site_id"], booking["date"], booking["time"])
+    if status == "cancelled":
+        await release_seats(*slot, booking["group_size"])
+        return True
+    return await reserve_seats(*slot, booking["group_size"], force=force)
+
+async def rebuild_slot_occupancy() -> int:
+    """Recompute slot_occupancy from the pending and confirmed bookings; returns the number of slots
+
+    Like reconcile_booking_counters, seats taken while it runs can be overwritten.
+    """
+    slots = await db.bookings.aggregate([
+        {"$match": {"status": {"$ne": "cancelled"}}},
+        {"$group": {"_id": {"site_id": "$site_id", "date": "$date", "time": "$time"}, "booked": {"$sum": "$group_size"}}},
+    ]).to_list(length=None)
+    ids = [slot_id(slot["_id"]["site_id"], slot["_id"]["date"], slot["_id"]["time"]) for slot in slots]
+    operations = [
+        ReplaceOne({"_id": _id}, {**slot["_id"], "booked": slot["booked"]}, upsert=True)
+        for _id, slot in zip(ids, slots)
+    ]
+    for i in range(0, len(operations), BULK_INSERT_CHUNK_SIZE):
+        await db.slot_occupancy.bulk_write(operations[i:i + BULK_INSERT_CHUNK_SIZE], ordered=False)
+    await db.slot_occupancy.delete_many({"_id": {"$nin": ids}})
+    logging.info("Slot occupancy rebuilt: %s slots", len(ids))
+    return len(ids)
+
+async def reserve_booking_seats(bookings: List[dict]) -> Set[str]:
+    """Take seats for many bookings, one $inc per slot when the whole slot group fits; returns the ids that did not fit"""
+    groups: Dict[str, List[dict]] = {}
+    for booking in bookings:
+        groups.setdefault(slot_id(booking["site_id"], booking["date"], booking["time"]), []).append(booking)
+    full: Set[str] = set()
+
+    async def reserve_group(group: List[dict]):
+        slot = (group[0]["site_id"], group[0]["date"], group[0]["time"])
+        if await reserve_seats(*slot, sum(booking["group_size"] for booking in group)):
+            return
+        # Fill the slot in the given order with the bookings that still fit
+        for booking in group:
+            if not await reserve_seats(*slot, booking["group_size"]):
+                full.add(booking["id"])
+
+    await asyncio.gather(*(reserve_group(group) for group in groups.values()))
+    return full
+
+async def release_booking_seats(bookings: List[dict]):
+    """Give back the seats of many bookings, one $inc per slot"""
+    slots: Counter = Counter()
+    for booking in bookings:
+        if "group_size" in booking:
+            slots[(booking["site_id"], booking["date"], booking["time"])] += booking["group_size"]
+    await asyncio.gather(*(release_seats(*slot, seats) for slot, seats in slots.items()))
+
+async def reserve_bulk_seats(valid: List[Tuple[int, dict]], results: List[BulkBookingItemResult]):
+    """Take seats for every valid bulk item; items that do not fit are marked failed and dropped from `valid`"""
+    full = await reserve_booking_seats([document for _, document in valid])
+    for index, document in valid:
+        if document["id"] in full:
+            results[index].status = "failed"
+            results[index].errors = [{"msg": "Time slot is full"}]
+    valid[:] = [item for item in valid if results[item[0]].status == "created"]
+
+# Booking analytics counters
+# booking_counters holds one document of running totals per status and
+# booking_site_stats one document per site name ({_id, count, total_revenue}).
+# Writers $inc them; reconcile_booking_counters() rebuilds both from bookings.
+BOOKING_STATUSES = ("pending", "confirmed", "cancelled")
+BOOKING_COUNTERS_ID = "bookings"
+BOOKING_COUNTERS_RECONCILE_INTERVAL = float(os.environ.get('BOOKING_COUNTERS_RECONCILE_INTERVAL', '3600'))
+
+# Booking rollups
+# booking_rollups holds one document per UTC day and per UTC hour of created_at:
+# {_id: "day:<bucket>", granularity, bucket, count, revenue,
+#  cells: {"<site_id>|<status>": {count, revenue}}}
+# so a year of daily figures is ~365 small documents whatever the booking volume.
+ROLLUP_GRANULARITIES = {"day": timedelta(days=1), "hour": timedelta(hours=1)}
+# Keep hourly queries bounded; daily ones cover at most ten years
+ROLLUP_MAX_BUCKETS = {"day": 3660, "hour": 24 * 31}
+
+def rollup_bucket(moment: datetime, granularity: str) -> datetime:
+    moment = moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    if granularity == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def rollup_id(granularity: str, bucket: datetime) -> str:
+    return f"{granularity}:{bucket.isoformat()}"
+
+def rollup_cell(site_id, status: str) -> str:
+    return f"{site_id}|{status}"
+
+def add_rollup_increments(updates: Dict[Tuple[str, datetime], Counter], booking: dict, status: str,
+                          sign: int, totals: bool = True):
+    created_at = booking["created_at"]
+    if isinstance(created_at, str):
+        created_at = parse_datetime(created_at)
+    price = sign * booking.get("total_price", 0)
+    cell = rollup_cell(booking.get("site_id"), status)
+    for granularity in ROLLUP_GRANULARITIES:
+        increments = updates.setdefault((granularity, rollup_bucket(created_at, granularity)), Counter())
+        if totals:
+            increments["count"] += sign
+            increments["revenue"] += price
+        increments[f"cells.{cell}.count"] += sign
+        increments[f"cells.{cell}.revenue"] += price
+
+def rollup_operations(updates: Dict[Tuple[str, datetime], Counter]) -> List[UpdateOne]:
+    return [
+        UpdateOne(
+            {"_id": rollup_id(granularity, bucket)},
+            {"$inc": dict(increments), "$setOnInsert": {"granularity": granularity, "bucket": bucket}},
+            upsert=True
+        )
+        for (granularity, bucket), increments in updates.items()
+    ]
+
+async def record_bookings_created(bookings: List[dict]):
+    """Fold newly inserted booking documents into the analytics counters and rollups"""
+    if not bookings:
+        return
+    increments = {"total": len(bookings)}
+    increments.update(Counter(booking["status"] for booking in bookings))
+    sites: Dict[str, List[float]] = {}
+    rollups: Dict[Tuple[str, datetime], Counter] = {}
+    for booking in bookings:
+        site = sites.setdefault(booking["site_name"], [0, 0.0])
+        site[0] += 1
+        site[1] += booking["total_price"]
+        add_rollup_increments(rollups, booking, booking["status"], 1)
+    try:
+        await asyncio.gather(
+            db.booking_counters.update_one({"_id": BOOKING_COUNTERS_ID}, {"$inc": increments}, upsert=True),
+            db.booking_site_stats.bulk_write([
+                UpdateOne({"_id": name}, {"$inc": {"count": count, "total_revenue": revenue}}, upsert=True)
+                for name, (count, revenue) in sites.items()
+            ], ordered=False),
+            db.booking_rollups.bulk_write(rollup_operations(rollups), ordered=False)
+        )
+    except PyMongoError as e:
+        # The booking itself is stored; the next reconciliation repairs the counters
+        logging.error("Error updating booking counters: %s", e)
+
+async def record_status_changes(bookings: List[dict], status: str):
+    """Move bookings between status counters and rollup cells; each dict holds a booking's previous state"""
+    increments: Counter = Counter()
+    rollups: Dict[Tuple[str, datetime], Counter] = {}
+    for booking in bookings:
+        previous = booking.get("status")
+        if previous == status:
+            continue
+        increments[status] += 1
+        if previous:
+            increments[previous] -= 1
+        if booking.get("created_at"):
+            if previous:
+                add_rollup_increments(rollups, booking, previous, -1, totals=False)
+            add_rollup_increments(rollups, booking, status, 1, totals=False)
+    if not increments:
+        return
+    writes = [db.booking_counters.update_one({"_id": BOOKING_COUNTERS_ID}, {"$inc": dict(increments)}, upsert=True)]
+    if rollups:
+        writes.append(db.booking_rollups.bulk_write(rollup_operations(rollups), ordered=False))
+    try:
+        await asyncio.gather(*writes)
+    except PyMongoError as e:
+        logging.error("Error updating booking counters: %s", e)
+
+async def record_status_change(booking: dict, status: str):
+    await record_status_changes([booking], status)
+
+BOOKING_STATUS_PROJECTION = {
+    "_id": 0, "status": 1, "created_at": 1, "site_id": 1, "total_price": 1, "date": 1, "time": 1, "group_size": 1
+}
+
+# Operator transitions: status -> the statuses it may move to. Payment confirmations
+# bypass this; re-opening a cancelled booking needs its seats back
+BOOKING_TRANSITIONS = {
+    "pending": ("confirmed", "cancelled"),
+    "confirmed": ("cancelled",),
+    "cancelled": ("pending",),
+}
+BOOKING_STATUS_BATCH_SIZE = int(os.environ.get('BOOKING_STATUS_BATCH_SIZE', '500'))
+
+def transition_sources(status: str) -> List[str]:
+    """Statuses a booking may move to `status` from"""
+    return [source for source, targets in BOOKING_TRANSITIONS.items() if status in targets]
+
+async def write_booking_status(booking_id: str, status: str, only_if_changed: bool = False,
+                               session=None, from_statuses: Optional[List[str]] = None) -> Optional[dict]:
+    """Set a booking's status without touching the counters; returns the booking as it was before
+
+    With only_if_changed the write is skipped (and None returned) when the booking already
+    has that status, which makes repeated confirmations no-ops. from_statuses limits the
+    write to bookings currently in one of those statuses.
+    """
+    query = {"id": booking_id}
+    if only_if_changed:
+        query["status"] = {"$ne": status}
+    if from_statuses is not None:
+        query["status"] = {"$in": from_statuses}
+    return await db.bookings.find_one_and_update(
+        query,
+        {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}},
+        projection=BOOKING_STATUS_PROJECTION,
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    )
+
+async def set_booking_status(booking_id: str, status: str) -> Optional[str]:
+    """Set a booking's status and keep the counters and slot seats in step; returns the previous status, or None if not found
+
+    Transitions outside BOOKING_TRANSITIONS, and re-opening a cancelled booking whose slot
+    has filled up meanwhile, are answered with 409.
+    """
+    previous = await write_booking_status(booking_id, status, from_statuses=[status, *transition_sources(status)])
+    if previous is None:
+        current = await db.bookings.find_one({"id": booking_id}, {"_id": 0, "status": 1})
+        if current is None:
+            return None
+        raise HTTPException(status_code=409, detail=f"Cannot change a {current.get('status')} booking to {status}")
+    if not await move_slot_seats(previous, status, force=False):
+        await write_booking_status(booking_id, previous.get("status", "cancelled"))
+        raise HTTPException(status_code=409, detail="Time slot is full")
+    await record_status_change(previous, status)
+    return previous.get("status", "")
+
+async def transition_bookings(query: dict, status: str, batch_size: int = BOOKING_STATUS_BATCH_SIZE,
+                              max_batches: Optional[int] = None) -> Dict[str, int]:
+    """Move every booking matching query whose current status allows it to `status`; returns counts
+
+    Works in batches of batch_size: one guarded update_many per previous status, then one
+    counters update and one $inc per slot. Re-opened bookings whose slot is full stay
+    cancelled and are counted as slot_full. With max_batches set it stops after that many
+    batches and leaves the rest for the next call.
+    """
+    guarded = {"$and": [query, {"status": {"$in": transition_sources(status)}}]}
+    projection = {**BOOKING_STATUS_PROJECTION, "id": 1}
+    counts = {"matched": 0, "modified": 0, "slot_full": 0}
+    full: Set[str] = set()
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batches += 1
+        batch_query = {"$and": [guarded, {"id": {"$nin": list(full)}}]} if full else guarded
+        bookings = await db.bookings.find(batch_query, projection).limit(batch_size).to_list(length=batch_size)
+        if not bookings:
+            return counts
+        counts["matched"] += len(bookings)
+        reopened = []
+        if status != "cancelled":
+            reopened = [booking for booking in bookings if booking.get("status") == "cancelled" and "group_size" in booking]
+            batch_full = await reserve_booking_seats(reopened)
+            if batch_full:
+                full |= batch_full
+                counts["slot_full"] += len(batch_full)
+                bookings = [booking for booking in bookings if booking["id"] not in batch_full]
+                reopened = [booking for booking in reopened if booking["id"] not in batch_full]
+
+        # Mongo keeps milliseconds; the stamp identifies our writes if others raced us
+        now = datetime.now(timezone.utc)
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        groups: Dict[str, List[dict]] = {}
+        for booking in bookings:
+            groups.setdefault(booking.get("status"), []).append(booking)
+        changed = []
+        for previous, group in groups.items():
+            ids = [booking["id"] for booking in group]
+            result = await db.bookings.update_many(
+                {"id": {"$in": ids}, "status": previous}, {"$set": {"status": status, "updated_at": now}}
+            )
+            if result.modified_count == len(group):
+                changed.extend(group)
+                continue
+            ours = {
+                booking["id"] async for booking in
+                db.bookings.find({"id": {"$in": ids}, "status": status, "updated_at": now}, {"_id": 0, "id": 1})
+            }
+            changed.extend(booking for booking in group if booking["id"] in ours)
+
+        changed_ids = {booking["id"] for booking in changed}
+        # Seats taken for bookings that someone else moved first go back
+        await release_booking_seats([booking for booking in reopened if booking["id"] not in changed_ids])
+        if status == "cancelled":
+            await release_booking_seats(changed)
+        await record_status_changes(changed, status)
+        counts["modified"] += len(changed)
+    return counts
+
+def booking_analytics_pipeline(site_limit: Optional[int] = None) -> List[dict]:
+    """Single-pass $facet aggregation over bookings: counts per status and per-site totals"""
+    sites = [
+        {"$group": {"_id": "$site_name", "count": {"$sum": 1}, "total_revenue": {"$sum": "$total_price"}}},
+        {"$sort": {"count": -1}},
+    ]
+    if site_limit:
+        sites.append({"$limit": site_limit})
+    return [{"$facet": {
+        "by_status": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+        "sites": sites,
+    }}]
+
+async def aggregate_booking_analytics(site_limit: Optional[int] = None, database=None) -> Tuple[dict, List[dict]]:
+    """Compute the counters straight from bookings (the primary unless database is given); returns (counters, sites)"""
+    database = db if database is None else database
+    facets = await database.bookings.aggregate(booking_analytics_pipeline(site_limit)).to_list(length=1)
+    by_status = {row["_id"]: row["count"] for row in facets[0]["by_status"]} if facets else {}
+    counters = {"total": sum(by_status.values())}
+    counters.update({status: by_status.get(status, 0) for status in BOOKING_STATUSES})
+    return counters, facets[0]["sites"] if facets else []
+
+async def reconcile_booking_counters() -> dict:
+    """Rebuild booking_counters and booking_site_stats from scratch
+
+    Increments that land between the aggregation and the writes below are
+    overwritten, so the counters can be off by the writes of that window
+    until the next run.
+    """
+    counters, sites = await aggregate_booking_analytics()
+    counters["reconciled_at"] = datetime.now(timezone.utc)
+    await db.booking_counters.replace_one({"_id": BOOKING_COUNTERS_ID}, counters, upsert=True)
+    if sites:
+        await db.booking_site_stats.bulk_write([
+            ReplaceOne({"_id": site["_id"]}, {"count": site["count"], "total_revenue": site["total_revenue"]}, upsert=True)
+            for site in sites
+        ], ordered=False)
+    await db.booking_site_stats.delete_many({"_id": {"$nin": [site["_id"] for site in sites]}})
+    logging.info("Booking counters reconciled: %s bookings across %s sites", counters['total'], len(sites))
+    return counters
+
+def parse_range_bound(value: str, name: str) -> Tuple[datetime, bool]:
+    """Parse a from/to query value; returns (moment, whether it was a bare date)"""
+    try:
+        return parse_datetime(value), len(value) == 10
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid '{name}', expected an ISO date or datetime")
+
+def booking_analytics_response(counters: dict, popular_sites: List[dict]) -> dict:
+    return {
+        "total_bookings": counters.get("total", 0),
+        "pending_bookings": counters.get("pending", 0),
+        "confirmed_bookings": counters.get("confirmed", 0),
+        "cancelled_bookings": counters.get("cancelled", 0),
+        "popular_sites": popular_sites
+    }
+
+# Background tasks
+background_tasks: List[asyncio.Task] = []
+
+async def run_periodically(name: str, interval: float, func):
+    """Call func every `interval` seconds until cancelled, logging failures"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Background task %s failed: %s", name, e)
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.append(task)
+    return task
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+# Stripe payment client
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', '20'))
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', '5'))
+STRIPE_MAX_CONCURRENCY = int(os.environ.get('STRIPE_MAX_CONCURRENCY', '20'))
+STRIPE_POOL_SIZE = int(os.environ.get('STRIPE_POOL_SIZE', str(STRIPE_MAX_CONCURRENCY)))
+STRIPE_MAX_RETRIES = int(os.environ.get('STRIPE_MAX_RETRIES', '2'))
+STRIPE_RETRY_BASE_DELAY = float(os.environ.get('STRIPE_RETRY_BASE_DELAY', '0.25'))
+
+@functools.lru_cache(maxsize=None)
+def stripe_retry_errors() -> Tuple[tuple, tuple]:
+    """Transient errors worth retrying, and the subset guaranteeing Stripe did not act on the request"""
+    stripe = stripe_sdk()
+    if stripe is None:
+        return (asyncio.TimeoutError, ConnectionError), ()
+    transient = (asyncio.TimeoutError, ConnectionError, stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError)
+    # Only these make even creates safe to retry
+    return transient, (stripe.RateLimitError,)
+
+class PaymentClient:
+    """Process-wide Stripe access: one StripeCheckout per webhook URL over a shared keep-alive HTTP pool,
+    with bounded concurrency, a deadline per call and jittered retries on transient errors"""
+
+    def __init__(self, api_key: Optional[str]):
+        self.api_key = api_key
+        self._checkouts: Dict[str, Any] = {}
+        self._semaphore = asyncio.Semaphore(STRIPE_MAX_CONCURRENCY)
+        self._session = None
+        self._http_client = None
+
+    def start(self):
+        """Install the pooled HTTP client that the stripe library uses for every request"""
+        stripe = stripe_sdk()
+        if stripe is None or self._http_client is not None:
+            return
+        import requests
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._http_client = stripe.RequestsClient(
+            timeout=(STRIPE_CONNECT_TIMEOUT, STRIPE_TIMEOUT),
+            session=self._session,
+            async_fallback_client=stripe.HTTPXClient(timeout=STRIPE_TIMEOUT)
+        )
+        stripe.default_http_client = self._http_client
+
+    async def close(self):
+        if self._http_client is not None:
+            await self._http_client.close_async()
+            self._session.close()
+            if stripe_sdk().default_http_client is self._http_client:
+                stripe_sdk().default_http_client = None
+            self._http_client = None
+            self._session = None
+        self._checkouts.clear()
+
+    def checkout(self, webhook_url: str = ""):
+        stripe_checkout = self._checkouts.get(webhook_url)
+        if stripe_checkout is None:
+            # First Stripe use in this process imports the integration and installs the pool
+            checkout_class = stripe_checkout_module().StripeCheckout
+            self.start()
+            stripe_checkout = checkout_class(api_key=self.api_key, webhook_url=webhook_url)
+            self._checkouts[webhook_url] = stripe_checkout
+        return stripe_checkout
 
-def parse_from_mongo(item):
-    if isinstance(item, dict):
-        for key, value in item.items():
-            if isinstance(value, str) and 'T' in value:
+    async def call(self, name: str, func, *args, idempotent: bool = True):
+        transient_errors, not_processed_errors = stripe_retry_errors()
+        attempt = 0
+        while True:
+            try:
+                # The span includes waiting for a concurrency slot, the histogram only the call
+                with trace_span(f"stripe.{name}", attempt=attempt):
+                    async with self._semaphore:
+                        start = time.perf_counter()
+                        outcome = "error"
+                        try:
+                            result = await asyncio.wait_for(func(*args), timeout=STRIPE_TIMEOUT)
+                            outcome = "ok"
+                            return result
+                        finally:
+                            stripe_request_duration.labels(name, outcome).observe(time.perf_counter() - start)
+            except transient_errors as e:
+                retryable = idempotent or isinstance(e, not_processed_errors)
+                if not retryable or attempt >= STRIPE_MAX_RETRIES:
+                    raise
+                # Full jitter: spread retries from many requests over the whole backoff window
+                delay = random.uniform(0, STRIPE_RETRY_BASE_DELAY * 2 ** attempt)
+                attempt += 1
+                logging.warning("Stripe %s failed (%r), retry %s/%s in %.2fs", name, e, attempt, STRIPE_MAX_RETRIES, delay)
+                await asyncio.sleep(delay)
+
+    async def create_checkout_session(self, webhook_url: str, checkout_request) -> CheckoutSessionResponse:
+        return await self.call(
+            "create_checkout_session", self.checkout(webhook_url).create_checkout_session, checkout_request,
+            idempotent=False
+        )
+
+    async def get_checkout_status(self, session_id: str) -> CheckoutStatusResponse:
+        return await self.call("get_checkout_status", self.checkout().get_checkout_status, session_id)
+
+    async def handle_webhook(self, body: bytes, signature: str):
+        # Signature verification is local, nothing to pool or retry
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await traced("stripe.handle_webhook", self.checkout().handle_webhook(body, signature))
+            outcome = "ok"
+            return result
+        finally:
+            stripe_request_duration.labels("handle_webhook", outcome).observe(time.perf_counter() - start)
+
+payment_client = PaymentClient(stripe_api_key)
+
+# Checkout status cache
+CHECKOUT_STATUS_TTL = float(os.environ.get('CHECKOUT_STATUS_TTL', '5'))
+CHECKOUT_STATUS_CACHE_SIZE = int(os.environ.get('CHECKOUT_STATUS_CACHE_SIZE', '10000'))
+
+def is_terminal_checkout_status(status_response: CheckoutStatusResponse) -> bool:
+    """Paid and expired sessions never change again"""
+    return status_response.payment_status == "paid" or status_response.status == "expired"
+
+class CheckoutStatusCache:
+    """Stripe checkout status per session_id: short TTL while open, kept for good once terminal,
+    and at most one upstream fetch in flight per session however many clients poll"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[CheckoutStatusResponse, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get(self, session_id: str, fetch) -> CheckoutStatusResponse:
+        entry = self._entries.get(session_id)
+        if entry is not None and time.monotonic() < entry[1]:
+            self._entries.move_to_end(session_id)
+            return entry[0]
+        future = self._inflight.get(session_id)
+        if future is None:
+            previous = entry[0] if entry is not None else None
+            future = asyncio.ensure_future(self._load(session_id, fetch, previous))
+            self._inflight[session_id] = future
+        # A poller that disconnects must not cancel the fetch the others are waiting on
+        return await asyncio.shield(future)
+
+    async def _load(self, session_id: str, fetch, previous: Optional[CheckoutStatusResponse]) -> CheckoutStatusResponse:
+        try:
+            status_response = await fetch(session_id, previous)
+            expires_at = float("inf") if is_terminal_checkout_status(status_response) else time.monotonic() + self.ttl
+            self._entries[session_id] = (status_response, expires_at)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return status_response
+        finally:
+            self._inflight.pop(session_id, None)
+
+    def invalidate(self, session_id: str):
+        """Drop a non-terminal entry so the next poll asks Stripe again"""
+        entry = self._entries.get(session_id)
+        if entry is not None and entry[1] != float("inf"):
+            del self._entries[session_id]
+
+checkout_status_cache = CheckoutStatusCache(CHECKOUT_STATUS_TTL, CHECKOUT_STATUS_CACHE_SIZE)
+
+# Payment status events
+# "memory" delivers events only inside this worker (streams re-read the payment on every
+# heartbeat to catch changes made by other workers); "mongo" follows a change stream on
+# payment_transactions so every worker sees every status change (requires a replica set).
+PAYMENT_EVENTS_BACKEND = os.environ.get('PAYMENT_EVENTS_BACKEND', 'memory').lower()
+PAYMENT_EVENTS_HEARTBEAT = float(os.environ.get('PAYMENT_EVENTS_HEARTBEAT', '15'))
+PAYMENT_EVENTS_MAX_AGE = float(os.environ.get('PAYMENT_EVENTS_MAX_AGE', '1800'))
+PAYMENT_TERMINAL_STATUSES = {"paid", "expired", "failed"}
+
+class PaymentEventBroker:
+    """Fans payment status changes out to the SSE/WebSocket subscribers of each session_id"""
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=8)
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(session_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[session_id]
+
+    def deliver(self, session_id: str, event: dict):
+        for queue in self._subscribers.get(session_id, ()):
+            if queue.full():
+                # A slow consumer only needs the latest status
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def publish(self, session_id: str, payment_status: str):
+        """Called after a status change is written; with the mongo backend the change stream delivers it"""
+        if self.backend != "mongo":
+            self.deliver(session_id, {"session_id": session_id, "payment_status": payment_status})
+
+    async def watch(self):
+        pipeline = [{"$match": {
+            "operationType": {"$in": ["insert", "update", "replace"]},
+            "fullDocument.session_id": {"$exists": True},
+        }}]
+        while True:
+            try:
+                async with db.payment_transactions.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        document = change.get("fullDocument") or {}
+                        if self._subscribers.get(document.get("session_id")):
+                            self.deliver(document["session_id"], {
+                                "session_id": document["session_id"],
+                                "payment_status": document.get("payment_status"),
+                            })
+            except OperationFailure as e:
+                logging.warning("Payment events change stream unavailable, delivering in-process only: %s", e)
+                self.backend = "memory"
+                return
+            except PyMongoError as e:
+                logging.warning("Payment events change stream interrupted, reconnecting: %s", e)
+                await asyncio.sleep(5)
+
+payment_events = PaymentEventBroker(PAYMENT_EVENTS_BACKEND)
+
+async def payment_status_events(session_id: str, is_disconnected=None):
+    """Yield the current payment status, then every change, until it is terminal or the connection ages out"""
+    # Subscribe before reading so a change between the read and the subscription is not lost
+    queue = payment_events.subscribe(session_id)
+    try:
+        transaction = await db.payment_transactions.find_one(
+            {"session_id": session_id}, {"_id": 0, "session_id": 1, "payment_status": 1}
+        )
+        if transaction is None:
+            yield {"session_id": session_id, "error": "Payment session not found"}
+            return
+        last_status = transaction.get("payment_status")
+        if last_status not in PAYMENT_TERMINAL_STATUSES:
+            # One (cached, coalesced) Stripe lookup in case the webhook has not arrived yet
+            try:
+                last_status = recorded_payment_status(await checkout_status_cache.get(session_id, fetch_checkout_status))
+            except Exception as e:
+                logging.warning("Could not refresh checkout status %s: %s", session_id, e)
+        yield {"session_id": session_id, "payment_status": last_status}
+
+        deadline = time.monotonic() + PAYMENT_EVENTS_MAX_AGE
+        while last_status not in PAYMENT_TERMINAL_STATUSES and time.monotonic() < deadline:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=PAYMENT_EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if is_disconnected is not None and await is_disconnected():
+                    return
+                if payment_events.backend == "memory":
+                    # Changes applied by other workers never reach this queue; read them instead
+                    transaction = await db.payment_transactions.find_one(
+                        {"session_id": session_id}, {"_id": 0, "payment_status": 1}
+                    )
+                    if transaction is not None and transaction.get("payment_status") != last_status:
+                        last_status = transaction.get("payment_status")
+                        yield {"session_id": session_id, "payment_status": last_status}
+                        continue
+                yield None  # heartbeat
+                continue
+            if event.get("payment_status") != last_status:
+                last_status = event.get("payment_status")
+                yield event
+    finally:
+        payment_events.unsubscribe(session_id, queue)
+
+# Payment confirmation
+# "transaction" writes the payment status and the booking confirmation in one Mongo
+# transaction (replica set or sharded cluster only). "outbox" marks the payment document
+# itself with confirmation_pending in the same atomic update, confirms the booking, and
+# leaves recover_payment_confirmations() to finish any confirmation a crash interrupted.
+# "auto" picks transaction when the deployment supports it.
+PAYMENT_CONFIRMATION_MODE = os.environ.get('PAYMENT_CONFIRMATION_MODE', 'auto').lower()
+PAYMENT_OUTBOX_GRACE_SECONDS = float(os.environ.get('PAYMENT_OUTBOX_GRACE_SECONDS', '30'))
+# The recovery runs every grace period, but never more often than this
+PAYMENT_OUTBOX_MIN_INTERVAL = float(os.environ.get('PAYMENT_OUTBOX_MIN_INTERVAL', '5'))
+payment_transactions_enabled = False
+
+async def detect_transaction_support() -> bool:
+    hello = await client.admin.command("hello")
+    return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+async def apply_payment_status(session_id: str, payment_status: str, source: str = "payment") -> bool:
+    """Move a payment to a new status exactly once and, when it becomes paid, confirm its booking
+
+    The conditional filter makes the transition race-free across requests and workers:
+    only one caller sees the old document, the rest match nothing. Final statuses
+    (paid, expired, failed) are never left. Returns whether this call made the change.
+    """
+    guard = {"session_id": session_id, "payment_status": {"$nin": [payment_status, *PAYMENT_TERMINAL_STATUSES]}}
+    changes = {"payment_status": payment_status, "updated_at": datetime.now(timezone.utc)}
+    projection = {"_id": 0, "booking_id": 1, "payment_status": 1}
+    confirm = payment_status == "paid"
+
+    if confirm and payment_transactions_enabled:
+        async def confirm_in_transaction(mongo_session):
+            transaction = await db.payment_transactions.find_one_and_update(
+                guard, {"$set": changes}, projection=projection,
+                return_document=ReturnDocument.BEFORE, session=mongo_session
+            )
+            booking = None
+            if transaction and transaction.get("booking_id"):
+                booking = await write_booking_status(
+                    transaction["booking_id"], "confirmed", only_if_changed=True, session=mongo_session
+                )
+            return transaction, booking
+
+        async with await client.start_session() as mongo_session:
+            transaction, booking = await mongo_session.with_transaction(confirm_in_transaction)
+    else:
+        if confirm:
+            changes["confirmation_pending"] = True
+        transaction = await db.payment_transactions.find_one_and_update(
+            guard, {"$set": changes}, projection=projection, return_document=ReturnDocument.BEFORE
+        )
+        booking = None
+        if confirm and transaction and transaction.get("booking_id"):
+            booking = await write_booking_status(transaction["booking_id"], "confirmed", only_if_changed=True)
+        if confirm and transaction:
+            # The booking is written; from here on recovery must not touch it again
+            await db.payment_transactions.update_one(
+                {"session_id": session_id, "confirmation_pending": True}, {"$unset": {"confirmation_pending": ""}}
+            )
+
+    if transaction is None:
+        return False
+    payment_events.publish(session_id, payment_status)
+    if booking is not None:
+        # A paid booking keeps its seats even if its slot filled up after a cancellation
+        await move_slot_seats(booking, "confirmed")
+        await record_status_change(booking, "confirmed")
+        logging.info("Booking %s confirmed via %s %s", transaction['booking_id'], source, session_id)
+    return True
+
+async def recover_payment_confirmations(limit: int = 500) -> int:
+    """Finish outbox confirmations: confirm the booking of every paid payment still marked pending
+
+    Only bookings still pending are confirmed; one an operator changed after it was
+    confirmed keeps its status.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=PAYMENT_OUTBOX_GRACE_SECONDS)
+    pending = await db.payment_transactions.find(
+        {"confirmation_pending": True, "updated_at": {"$lt": cutoff}},
+        {"_id": 1, "session_id": 1, "booking_id": 1}
+    ).limit(limit).to_list(length=limit)
+    for transaction in pending:
+        if transaction.get("booking_id"):
+            booking = await write_booking_status(transaction["booking_id"], "confirmed", from_statuses=["pending"])
+            if booking is not None:
+                await record_status_change(booking, "confirmed")
+                logging.info("Booking %s confirmed via outbox recovery %s", transaction['booking_id'], transaction['session_id'])
+    if pending:
+        await db.payment_transactions.update_many(
+            {"_id": {"$in": [transaction["_id"] for transaction in pending]}, "confirmation_pending": True},
+            {"$unset": {"confirmation_pending": ""}}
+        )
+    return len(pending)
+
+def recorded_payment_status(status_response: CheckoutStatusResponse) -> str:
+    """The payment_status we store: Stripe reports an expired session as unpaid"""
+    return "expired" if status_response.status == "expired" else status_response.payment_status
+
+async def fetch_checkout_status(session_id: str, previous: Optional[CheckoutStatusResponse]) -> CheckoutStatusResponse:
+    status_response = await payment_client.get_checkout_status(session_id)
+    # The previous cached status was already recorded, so only a change needs a write
+    if previous is None or recorded_payment_status(previous) != recorded_payment_status(status_response):
+        await traced("apply_payment_status", apply_payment_status(session_id, recorded_payment_status(status_response)))
+    return status_response
+
+# Stripe webhook inbox
+# The webhook only verifies the signature and stores the event, keyed by Stripe's event id
+# so retried deliveries are no-ops; background workers apply the events in batches.
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '2'))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '50'))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', '1'))
+WEBHOOK_LEASE_SECONDS = float(os.environ.get('WEBHOOK_LEASE_SECONDS', '60'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_RETENTION_SECONDS = int(os.environ.get('WEBHOOK_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+class WebhookInbox:
+    """Durable, deduplicated queue of verified Stripe events stored in webhook_inbox"""
+
+    def __init__(self):
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def enqueue(self, event, body: bytes) -> bool:
+        """Store a verified event; returns False if this event id was already received"""
+        now = datetime.now(timezone.utc)
+        try:
+            await db.webhook_inbox.insert_one({
+                "_id": event.event_id,
+                "event_type": event.event_type,
+                "session_id": event.session_id,
+                "payment_status": event.payment_status,
+                "raw": body.decode("utf-8", errors="replace"),
+                "status": "pending",
+                "attempts": 0,
+                "received_at": now,
+                "next_attempt_at": now,
+            })
+        except DuplicateKeyError:
+            return False
+        self._notify()
+        return True
+
+    async def claim_batch(self) -> List[dict]:
+        """Lease up to WEBHOOK_BATCH_SIZE due events, including ones abandoned by a dead worker"""
+        now = datetime.now(timezone.utc)
+        claimable = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "locked_until": {"$lt": now}},
+        ]}
+        candidates = await db.webhook_inbox.find(claimable, {"_id": 1}).sort("received_at", 1).limit(WEBHOOK_BATCH_SIZE).to_list(length=WEBHOOK_BATCH_SIZE)
+        if not candidates:
+            return []
+        claim = uuid.uuid4().hex
+        # Re-checking claimable in the update means two workers can never lease the same event
+        await db.webhook_inbox.update_many(
+            {"_id": {"$in": [candidate["_id"] for candidate in candidates]}, **claimable},
+            {"$set": {"status": "processing", "claim": claim,
+                      "locked_until": now + timedelta(seconds=WEBHOOK_LEASE_SECONDS)}}
+        )
+        return await db.webhook_inbox.find({"claim": claim, "status": "processing"}).to_list(length=WEBHOOK_BATCH_SIZE)
+
+    async def process(self, event: dict):
+        session_id = event.get("session_id")
+        if session_id and event.get("payment_status"):
+            await apply_payment_status(session_id, event["payment_status"], source="webhook")
+            # Pollers should see the new status on their next request
+            checkout_status_cache.invalidate(session_id)
+
+    async def drain_once(self) -> int:
+        events = await self.claim_batch()
+        if not events:
+            return 0
+        outcomes = await asyncio.gather(*(self.process(event) for event in events), return_exceptions=True)
+        now = datetime.now(timezone.utc)
+        updates = []
+        for event, outcome in zip(events, outcomes):
+            if not isinstance(outcome, Exception):
+                updates.append(UpdateOne({"_id": event["_id"], "claim": event["claim"]}, {
+                    "$set": {"status": "done", "processed_at": now},
+                    "$unset": {"claim": "", "locked_until": ""}
+                }))
+                continue
+            attempts = event.get("attempts", 0) + 1
+            logging.error("Error processing Stripe event %s (attempt %s): %s", event['_id'], attempts, outcome)
+            retry = {"status": "pending", "attempts": attempts, "last_error": str(outcome),
+                     "next_attempt_at": now + timedelta(seconds=min(300, 2 ** attempts))}
+            if attempts >= WEBHOOK_MAX_ATTEMPTS:
+                retry = {"status": "failed", "attempts": attempts, "last_error": str(outcome), "processed_at": now}
+            updates.append(UpdateOne({"_id": event["_id"], "claim": event["claim"]}, {
+                "$set": retry, "$unset": {"claim": "", "locked_until": ""}
+            }))
+        await db.webhook_inbox.bulk_write(updates, ordered=False)
+        return len(events)
+
+    async def run_worker(self, worker_id: int):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while True:
+            try:
+                if await self.drain_once() >= WEBHOOK_BATCH_SIZE:
+                    continue  # more waiting, keep draining
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Webhook worker %s failed: %s", worker_id, e)
+            # Woken by webhooks received in this process; polling picks up the other workers'
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+webhook_inbox = WebhookInbox()
+
+# Idempotency keys
+# A POST carrying an Idempotency-Key runs once per key: the response is stored in
+# idempotency_keys (expired by a TTL index) and replayed to every retry, and concurrent
+# requests with the same key in this process wait for the one doing the work.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+# A key left "processing" this long belongs to a request that died; the next retry takes it over
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+class IdempotencyStore:
+    def __init__(self):
+        # "<scope>:<key>" -> (request fingerprint, future of (replayed, response content))
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+
+    @staticmethod
+    def fingerprint(payload) -> str:
+        return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+    async def run(self, scope: str, key: Optional[str], payload, response: Response, func):
+        """Return func()'s result, or the stored result of an earlier request with the same key"""
+        if not key:
+            return await func()
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+        key_id = f"{scope}:{key}"
+        fingerprint = self.fingerprint(payload)
+        inflight = self._inflight.get(key_id)
+        joined = inflight is not None
+        if inflight is None:
+            inflight = (fingerprint, asyncio.ensure_future(self._execute(key_id, fingerprint, func)))
+            self._inflight[key_id] = inflight
+            inflight[1].add_done_callback(lambda _: self._inflight.pop(key_id, None))
+        if inflight[0] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        # A client that disconnects must not cancel the work the others are waiting on
+        replayed, content = await asyncio.shield(inflight[1])
+        if replayed or joined:
+            response.headers["Idempotent-Replayed"] = "true"
+        return content
+
+    async def _claim(self, key_id: str, fingerprint: str) -> Optional[dict]:
+        """Mark the key as processing; returns the stored record instead if it already completed"""
+        now = datetime.now(timezone.utc)
+        try:
+            await db.idempotency_keys.insert_one(
+                {"_id": key_id, "fingerprint": fingerprint, "status": "processing", "created_at": now}
+            )
+            return None
+        except DuplicateKeyError:
+            existing = await db.idempotency_keys.find_one({"_id": key_id})
+        if existing is None:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is being processed")
+        if existing.get("fingerprint") != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if existing.get("status") == "done":
+            return existing
+        stale = now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        taken_over = await db.idempotency_keys.find_one_and_update(
+            {"_id": key_id, "status": "processing", "created_at": {"$lt": stale}},
+            {"$set": {"created_at": now}}
+        )
+        if taken_over is None:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is being processed")
+        return None
+
+    async def _execute(self, key_id: str, fingerprint: str, func) -> Tuple[bool, Any]:
+        existing = await self._claim(key_id, fingerprint)
+        if existing is not None:
+            return True, existing["response"]
+        try:
+            content = jsonable_encoder(await func())
+        except BaseException:
+            # Nothing was stored, so a retry may run again
+            await db.idempotency_keys.delete_one({"_id": key_id, "status": "processing"})
+            raise
+        try:
+            await db.idempotency_keys.update_one(
+                {"_id": key_id},
+                {"$set": {"status": "done", "response": content, "completed_at": datetime.now(timezone.utc)}}
+            )
+        except PyMongoError as e:
+            # The work is done; a retry gets 409 until the lock goes stale
+            logging.error("Error storing response for idempotency key %s: %s", key_id, e)
+        return False, content
+
+idempotency_store = IdempotencyStore()
+
+# Booking write buffer
+# With BOOKING_WRITE_BUFFER on, bookings created within BOOKING_WRITE_BUFFER_DELAY_MS of each
+# other go to Mongo as one unordered insert_many (and one counters update) instead of an
+# insert_one each. BOOKING_WRITE_DURABILITY says when the request gets its answer:
+#   acknowledged  after insert_many is acknowledged with the collection's write concern
+#   journaled     after it is acknowledged by a majority and journaled
+#   buffered      as soon as the booking is queued; a failed flush only releases the seats and logs,
+#                 and bookings still queued when the process dies are lost
+BOOKING_WRITE_BUFFER = env_flag('BOOKING_WRITE_BUFFER')
+BOOKING_WRITE_BUFFER_DELAY_MS = float(os.environ.get('BOOKING_WRITE_BUFFER_DELAY_MS', '5'))
+BOOKING_WRITE_BUFFER_MAX_BATCH = int(os.environ.get('BOOKING_WRITE_BUFFER_MAX_BATCH', '500'))
+BOOKING_WRITE_DURABILITY = os.environ.get('BOOKING_WRITE_DURABILITY', 'acknowledged').lower()
+# Flushes run outside any request, so they get their own Mongo deadline (0 for none)
+BOOKING_WRITE_BUFFER_TIMEOUT = float(os.environ.get('BOOKING_WRITE_BUFFER_TIMEOUT', '10'))
+
+class BookingWriteBuffer:
+    """Coalesces concurrent booking inserts; every caller's future resolves with its own document's outcome
+
+    The buffer owns the rollback: a booking whose insert fails gets its slot seats released here.
+    """
+
+    def __init__(self, delay: float, max_batch: int, durability: str):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.durability = durability
+        self._pending: List[Tuple[dict, Optional[asyncio.Future]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def insert(self, document: dict):
+        """Queue one booking document; raises the error Mongo gave for it, unless durability is buffered"""
+        loop = asyncio.get_running_loop()
+        # Nobody waits for buffered writes, so they get no future
+        future = loop.create_future() if self.durability != "buffered" else None
+        self._pending.append((document, future))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            # A fresh context: the flush must not inherit this request's Mongo deadline or log context
+            self._timer = loop.call_later(self.delay, self.flush, context=Context())
+        if future is not None:
+            await future
+
+    def flush(self):
+        """Start writing everything queued so far"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._write(batch), context=Context())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def close(self):
+        """Write what is still queued and wait for flushes in flight"""
+        self.flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    @staticmethod
+    def _deadline():
+        """A fresh BOOKING_WRITE_BUFFER_TIMEOUT deadline, so bookkeeping still runs after the insert timed out"""
+        return pymongo.timeout(BOOKING_WRITE_BUFFER_TIMEOUT) if BOOKING_WRITE_BUFFER_TIMEOUT > 0 else contextlib.nullcontext()
+
+    async def _write(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        """Insert the batch, then resolve every waiting future, whatever happened on the way"""
+        errors: Dict[int, Exception] = {}
+        failure: Optional[Exception] = None
+        try:
+            errors = await self._write_batch(batch)
+        except Exception as e:
+            failure = e
+            logging.error("Booking write buffer: batch of %s failed: %s", len(batch), e)
+        finally:
+            for index, (_, future) in enumerate(batch):
+                if future is None or future.done():
+                    continue  # buffered, or the request went away
+                error = errors.get(index, failure)
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+    async def _write_batch(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]) -> Dict[int, Exception]:
+        """Insert the batch and keep seats and counters in step; returns the error per failed document"""
+        booking_write_batch_size.labels().observe(len(batch))
+        bookings = db.bookings
+        if self.durability == "journaled":
+            bookings = bookings.with_options(write_concern=WriteConcern(w="majority", j=True))
+        errors: Dict[int, Exception] = {}
+        try:
+            with self._deadline():
+                await bookings.insert_many([document for document, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                error_class = DuplicateKeyError if write_error.get("code") == 11000 else WriteError
+                errors[write_error["index"]] = error_class(
+                    write_error.get("errmsg", "Write failed"), write_error.get("code"), write_error
+                )
+        except PyMongoError as e:
+            # Unknown which documents made it: the stored ones keep their seats and succeed
+            with self._deadline():
+                stored = {
+                    booking["id"] async for booking in
+                    db.bookings.find({"id": {"$in": [document["id"] for document, _ in batch]}}, {"_id": 0, "id": 1})
+                }
+            errors = {index: e for index, (document, _) in enumerate(batch) if document["id"] not in stored}
+
+        with self._deadline():
+            if errors:
+                logging.error("Booking write buffer: %s of %s inserts failed: %s", len(errors), len(batch), next(iter(errors.values())))
+                await asyncio.gather(*(
+                    release_seats(document["site_id"], document["date"], document["time"], document["group_size"])
+                    for index, (document, _) in enumerate(batch) if index in errors
+                ))
+            await record_bookings_created([document for index, (document, _) in enumerate(batch) if index not in errors])
+        return errors
+
+booking_write_buffer = BookingWriteBuffer(
+    BOOKING_WRITE_BUFFER_DELAY_MS / 1000, BOOKING_WRITE_BUFFER_MAX_BATCH, BOOKING_WRITE_DURABILITY
+)
+
+# Expiry sweeper
+# Every EXPIRY_SWEEP_INTERVAL seconds the worker holding the "expiry_sweeper" lease in
+# scheduler_locks records Stripe's verdict on abandoned checkouts (pending past Stripe's 24-hour
+# session lifetime; a late payment is recorded as paid, not expired),
+# cancels stale pending bookings and moves old expired/failed payments to
+# payment_transactions_archive, whose TTL index drops them after EXPIRY_ARCHIVE_RETENTION_DAYS.
+# Each step handles at most EXPIRY_SWEEP_MAX_BATCHES batches of EXPIRY_SWEEP_BATCH_SIZE per
+# sweep; whatever is left waits for the next one.
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', '300'))
+EXPIRY_SWEEP_BATCH_SIZE = int(os.environ.get('EXPIRY_SWEEP_BATCH_SIZE', '200'))
+EXPIRY_SWEEP_MAX_BATCHES = int(os.environ.get('EXPIRY_SWEEP_MAX_BATCHES', '10'))
+CHECKOUT_EXPIRY_HOURS = float(os.environ.get('CHECKOUT_EXPIRY_HOURS', '25'))
+PENDING_BOOKING_EXPIRY_HOURS = float(os.environ.get('PENDING_BOOKING_EXPIRY_HOURS', '48'))
+EXPIRY_ARCHIVE_AFTER_DAYS = float(os.environ.get('EXPIRY_ARCHIVE_AFTER_DAYS', '30'))
+EXPIRY_ARCHIVE_RETENTION_DAYS = float(os.environ.get('EXPIRY_ARCHIVE_RETENTION_DAYS', '365'))
+# Abandoned checkouts are looked up one by one, so the sweep keeps to a few Stripe calls at a
+# time; a session Stripe still reports open (or fails to report) is asked again after this long
+EXPIRY_SWEEP_STRIPE_CONCURRENCY = int(os.environ.get('EXPIRY_SWEEP_STRIPE_CONCURRENCY', '4'))
+EXPIRY_SWEEP_RECHECK_HOURS = float(os.environ.get('EXPIRY_SWEEP_RECHECK_HOURS', '1'))
+# A leader that stops renewing is replaced once its lease runs out
+EXPIRY_SWEEP_LEASE_SECONDS = float(os.environ.get('EXPIRY_SWEEP_LEASE_SECONDS', str(max(2 * EXPIRY_SWEEP_INTERVAL, 60))))
+# Only payments nobody will look at again are archived; paid ones stay with their bookings
+PAYMENT_ARCHIVED_STATUSES = ("expired", "failed")
+
+class LeaderLease:
+    """A named lease in scheduler_locks; the holder renews it on every acquire, others take it once it lapses"""
+
+    def __init__(self, name: str, seconds: float):
+        self.name = name
+        self.seconds = seconds
+        self.owner = uuid.uuid4().hex
+
+    async def acquire(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            # Held by someone else and still valid: the filter misses and the upsert hits the _id
+            await db.scheduler_locks.update_one(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release(self):
+        await db.scheduler_locks.delete_one({"_id": self.name, "owner": self.owner})
+
+class ExpirySweeper:
+    def __init__(self, lease: LeaderLease):
+        self.lease = lease
+
+    async def run(self) -> Optional[Dict[str, int]]:
+        """One sweep if this worker holds the lease; returns records handled per step, None if not leader"""
+        if not await self.lease.acquire():
+            expiry_sweep_runs.labels("not_leader").inc()
+            return None
+        counts = {}
+        try:
+            for step, func in (("checkouts", self.expire_checkouts), ("bookings", self.expire_bookings),
+                               ("archive", self.archive_payments)):
+                started = time.perf_counter()
+                counts[step] = await func()
+                expiry_sweep_duration.labels(step).observe(time.perf_counter() - started)
+                expiry_sweep_records.labels(step).inc(counts[step])
+        except Exception:
+            expiry_sweep_runs.labels("failed").inc()
+            raise
+        limit = EXPIRY_SWEEP_BATCH_SIZE * EXPIRY_SWEEP_MAX_BATCHES
+        expiry_sweep_runs.labels("partial" if max(counts.values()) >= limit else "done").inc()
+        if any(counts.values()):
+            logging.info("Expiry sweep: %s", counts)
+        return counts
+
+    async def expire_checkouts(self) -> int:
+        """Record what Stripe reports for payments still pending after CHECKOUT_EXPIRY_HOURS
+
+        Expired is final in apply_payment_status, so it only comes from Stripe: a customer who
+        paid just before the session deadline, whose webhook is still being retried, gets paid.
+        Returns the payments that changed status.
+        """
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(hours=CHECKOUT_EXPIRY_HOURS)
+        recheck = now - timedelta(hours=EXPIRY_SWEEP_RECHECK_HOURS)
+        semaphore = asyncio.Semaphore(EXPIRY_SWEEP_STRIPE_CONCURRENCY)
+
+        async def settle(session_id: str) -> bool:
+            async with semaphore:
                 try:
-                    item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except ValueError:
-                    pass
-    return item
+                    status_response = await payment_client.get_checkout_status(session_id)
+                except Exception as e:
+                    logging.warning("Expiry sweep could not check checkout %s: %s", session_id, e)
+                    return False
+            payment_status = recorded_payment_status(status_response)
+            if payment_status not in PAYMENT_TERMINAL_STATUSES:
+                return False
+            changed = await apply_payment_status(session_id, payment_status, source="expiry sweep")
+            checkout_status_cache.invalidate(session_id)
+            return changed
+
+        settled = 0
+        for _ in range(EXPIRY_SWEEP_MAX_BATCHES):
+            pending = await db.payment_transactions.find(
+                {"payment_status": "pending", "created_at": {"$lt": cutoff},
+                 "$or": [{"expiry_checked_at": {"$exists": False}}, {"expiry_checked_at": {"$lt": recheck}}]},
+                {"_id": 0, "session_id": 1}
+            ).limit(EXPIRY_SWEEP_BATCH_SIZE).to_list(length=EXPIRY_SWEEP_BATCH_SIZE)
+            if not pending:
+                break
+            session_ids = [payment["session_id"] for payment in pending]
+            outcomes = await asyncio.gather(*(settle(session_id) for session_id in session_ids))
+            settled += sum(outcomes)
+            # Sessions still open, or that Stripe did not answer for, wait out EXPIRY_SWEEP_RECHECK_HOURS
+            await db.payment_transactions.update_many(
+                {"session_id": {"$in": session_ids}, "payment_status": "pending"},
+                {"$set": {"expiry_checked_at": datetime.now(timezone.utc)}}
+            )
+            if len(pending) < EXPIRY_SWEEP_BATCH_SIZE:
+                break
+        return settled
+
+    async def expire_bookings(self) -> int:
+        """Cancel bookings still pending after PENDING_BOOKING_EXPIRY_HOURS, releasing their seats"""
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=PENDING_BOOKING_EXPIRY_HOURS)
+        counts = await transition_bookings(
+            {"status": "pending", "created_at": {"$lt": cutoff}}, "cancelled",
+            batch_size=EXPIRY_SWEEP_BATCH_SIZE, max_batches=EXPIRY_SWEEP_MAX_BATCHES
+        )
+        return counts["modified"]
+
+    async def archive_payments(self) -> int:
+        """Move expired and failed payments older than EXPIRY_ARCHIVE_AFTER_DAYS to payment_transactions_archive"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=EXPIRY_ARCHIVE_AFTER_DAYS)
+        archived = 0
+        for _ in range(EXPIRY_SWEEP_MAX_BATCHES):
+            payments = await db.payment_transactions.find(
+                {"payment_status": {"$in": list(PAYMENT_ARCHIVED_STATUSES)}, "created_at": {"$lt": cutoff}}
+            ).limit(EXPIRY_SWEEP_BATCH_SIZE).to_list(length=EXPIRY_SWEEP_BATCH_SIZE)
+            if not payments:
+                break
+            now = datetime.now(timezone.utc)
+            # Copy first, delete second: a sweep that dies in between re-copies onto the same _id
+            await db.payment_transactions_archive.bulk_write(
+                [ReplaceOne({"_id": payment["_id"]}, {**payment, "archived_at": now}, upsert=True) for payment in payments],
+                ordered=False
+            )
+            result = await db.payment_transactions.delete_many({
+                "_id": {"$in": [payment["_id"] for payment in payments]},
+                "payment_status": {"$in": list(PAYMENT_ARCHIVED_STATUSES)}
+            })
+            archived += result.deleted_count
+            if len(payments) < EXPIRY_SWEEP_BATCH_SIZE:
+                break
+        return archived
+
+expiry_sweeper = ExpirySweeper(LeaderLease("expiry_sweeper", EXPIRY_SWEEP_LEASE_SECONDS))
+
+# Index registry
+# Every index the app relies on, declared once. On startup IndexManager compares them with
+# list_indexes, builds the missing ones in the background (the app serves meanwhile),
+# reports drift, and explains the queries the routes run to flag any that would COLLSCAN.
+INDEX_SELF_CHECK = env_flag('INDEX_SELF_CHECK', True)
+
+class IndexSpec:
+    __slots__ = ("collection", "keys", "options")
+
+    def __init__(self, collection: str, keys: List[Tuple[str, int]], **options):
+        self.collection = collection
+        self.keys = keys
+        self.options = options
+
+    @property
+    def name(self) -> str:
+        # The name create_index would pick, so indexes built before the registry are recognised
+        return "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+    def model(self) -> IndexModel:
+        return IndexModel(self.keys, name=self.name, **self.options)
+
+INDEX_OPTIONS_COMPARED = ("unique", "sparse", "expireAfterSeconds")
+
+INDEX_REGISTRY = [
+    IndexSpec("bookings", [("id", 1)], unique=True),
+    # Keyset pagination, with and without the email filter; their prefixes serve plain
+    # created_at and email lookups too
+    IndexSpec("bookings", [("created_at", -1), ("id", -1)]),
+    IndexSpec("bookings", [("email", 1), ("created_at", -1), ("id", -1)]),
+    # Status transitions by filter ("pending older than 48h"); the prefix serves plain status lookups
+    IndexSpec("bookings", [("status", 1), ("created_at", 1)]),
+    IndexSpec("historical_sites", [("id", 1)], unique=True),
+    IndexSpec("users", [("email", 1)], unique=True),
+    IndexSpec("booking_site_stats", [("count", -1)]),
+    IndexSpec("booking_rollups", [("granularity", 1), ("bucket", 1)]),
+    IndexSpec("site_capacity", [("site_id", 1)], unique=True),
+    IndexSpec("slot_occupancy", [("site_id", 1), ("date", 1)]),
+    IndexSpec("webhook_inbox", [("status", 1), ("next_attempt_at", 1)]),
+    IndexSpec("webhook_inbox", [("claim", 1)], sparse=True),
+    IndexSpec("webhook_inbox", [("processed_at", 1)], expireAfterSeconds=WEBHOOK_RETENTION_SECONDS),
+    IndexSpec("payment_transactions", [("session_id", 1)], unique=True),
+    IndexSpec("payment_transactions", [("booking_id", 1)]),
+    IndexSpec("payment_transactions", [("user_email", 1)]),
+    IndexSpec("payment_transactions", [("confirmation_pending", 1)], sparse=True),
+    # Expiry sweeps: pending checkouts past their lifetime, expired/failed ones due for the archive
+    IndexSpec("payment_transactions", [("payment_status", 1), ("created_at", 1)]),
+    IndexSpec("payment_transactions_archive", [("archived_at", 1)],
+              expireAfterSeconds=int(EXPIRY_ARCHIVE_RETENTION_DAYS * 24 * 3600)),
+    IndexSpec("idempotency_keys", [("created_at", 1)], expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS),
+]
+
+def route_query_shapes() -> List[Tuple[str, str, dict, Optional[list]]]:
+    """(label, collection, filter, sort) of the queries the routes and workers run"""
+    now = datetime.now(timezone.utc)
+    return [
+        ("GET /api/bookings", "bookings", booking_query(None), BOOKING_SORT),
+        ("GET /api/bookings?user_email", "bookings", booking_query("traveller@example.com"), BOOKING_SORT),
+        ("GET /api/bookings/{booking_id}", "bookings", {"id": "booking-id"}, None),
+        ("PATCH /api/bookings/status", "bookings",
+         {"status": "pending", "created_at": {"$lt": now - timedelta(hours=48)}, "site_id": 1}, None),
+        ("historical_sites by id", "historical_sites", {"id": "site-id"}, None),
+        ("GET /api/users/{email}", "users", {"email": "traveller@example.com"}, None),
+        ("GET /api/payments/checkout/status/{session_id}", "payment_transactions", {"session_id": "cs_test"}, None),
+        ("GET /api/sites/{site_id}/availability", "slot_occupancy",
+         {"site_id": 1, "date": {"$gte": "2025-01-01", "$lte": "2025-01-31"}}, None),
+        ("GET /api/analytics/bookings/timeseries", "booking_rollups",
+         {"granularity": "day", "bucket": {"$gte": now - timedelta(days=30), "$lt": now}}, None),
+        ("webhook inbox claim", "webhook_inbox", {"status": "pending", "next_attempt_at": {"$lte": now}}, None),
+        ("outbox recovery", "payment_transactions", {"confirmation_pending": True, "updated_at": {"$lt": now}}, None),
+        ("expiry sweep checkouts", "payment_transactions",
+         {"payment_status": "pending", "created_at": {"$lt": now - timedelta(hours=CHECKOUT_EXPIRY_HOURS)},
+          "$or": [{"expiry_checked_at": {"$exists": False}}, {"expiry_checked_at": {"$lt": now}}]}, None),
+        ("expiry sweep bookings", "bookings",
+         {"status": "pending", "created_at": {"$lt": now - timedelta(hours=PENDING_BOOKING_EXPIRY_HOURS)}}, None),
+        ("expiry sweep archive", "payment_transactions",
+         {"payment_status": {"$in": list(PAYMENT_ARCHIVED_STATUSES)},
+          "created_at": {"$lt": now - timedelta(days=EXPIRY_ARCHIVE_AFTER_DAYS)}}, None),
+    ]
+
+def plan_stages(plan: dict) -> List[str]:
+    """Stage names of a winning plan, across classic and slot-based explain output"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+class IndexManager:
+    def __init__(self, registry: List[IndexSpec]):
+        self.registry = registry
+        self.report: dict = {"status": "pending"}
+
+    async def sync_collection(self, collection: str, specs: List[IndexSpec]) -> dict:
+        existing = {index["name"]: index async for index in db[collection].list_indexes()}
+        missing, changed = [], []
+        for spec in specs:
+            index = existing.get(spec.name)
+            if index is None:
+                missing.append(spec)
+                continue
+            differences = {
+                option: {"expected": spec.options.get(option), "actual": index.get(option)}
+                for option in INDEX_OPTIONS_COMPARED
+                if spec.options.get(option) != index.get(option) and (spec.options.get(option) or index.get(option))
+            }
+            if differences:
+                changed.append({"name": spec.name, "options": differences})
+        expected = {spec.name for spec in specs}
+        unexpected = [name for name in existing if name != "_id_" and name not in expected]
+        if missing:
+            await db[collection].create_indexes([spec.model() for spec in missing])
+        return {"created": [spec.name for spec in missing], "changed": changed, "unexpected": unexpected}
+
+    async def sync(self) -> dict:
+        """Create missing indexes, concurrently per collection; changed and unexpected ones are only reported"""
+        by_collection: Dict[str, List[IndexSpec]] = {}
+        for spec in self.registry:
+            by_collection.setdefault(spec.collection, []).append(spec)
+        outcomes = await asyncio.gather(
+            *(self.sync_collection(collection, specs) for collection, specs in by_collection.items()),
+            return_exceptions=True
+        )
+        collections = {}
+        for collection, outcome in zip(by_collection, outcomes):
+            if isinstance(outcome, Exception):
+                logging.error("Error syncing indexes of %s: %s", collection, outcome)
+                collections[collection] = {"error": str(outcome)}
+                continue
+            collections[collection] = outcome
+            if outcome["created"]:
+                logging.info("Created indexes on %s: %s", collection, ", ".join(outcome["created"]))
+            for change in outcome["changed"]:
+                logging.warning("Index %s.%s differs from the registry: %s", collection, change["name"], change["options"])
+            if outcome["unexpected"]:
+                logging.warning("Indexes on %s not in the registry: %s", collection, ", ".join(outcome["unexpected"]))
+        return collections
+
+    async def check_query_plans(self) -> List[dict]:
+        """Explain each route query shape and return the ones whose winning plan scans a whole collection"""
+        collscans = []
+        for label, collection, query, sort in route_query_shapes():
+            cursor = db[collection].find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                explanation = await cursor.explain()
+            except Exception as e:
+                logging.warning("Could not explain %s: %s", label, e)
+                continue
+            stages = plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+            if "COLLSCAN" in stages:
+                logging.warning("Query of %s scans all of %s (plan: %s)", label, collection, " <- ".join(stages))
+                collscans.append({"query": label, "collection": collection, "stages": stages})
+        return collscans
+
+    async def run(self):
+        self.report = {"status": "running", "started_at": datetime.now(timezone.utc)}
+        collections = await self.sync()
+        report = {"status": "done", "started_at": self.report["started_at"], "collections": collections}
+        if INDEX_SELF_CHECK:
+            report["collscans"] = await self.check_query_plans()
+        report["finished_at"] = datetime.now(timezone.utc)
+        self.report = report
+        logging.info("Index sync finished")
+
+index_manager = IndexManager(INDEX_REGISTRY)
+
+# Readiness
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+app_ready = False
 
 # Routes
 @api_router.get("/")
@@ -129,77 +2688,313 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@api_router.get("/ready")
+async def readiness_check(response: Response):
+    """503 until warm-up has finished and while Mongo does not answer; /health never touches the database"""
+    checks = {"warm_up": app_ready, "mongo": False}
+    if client is not None:
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), timeout=READINESS_TIMEOUT)
+            checks["mongo"] = True
+        except Exception as e:
+            logging.warning("Readiness check could not reach Mongo: %s", e)
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "not ready", "checks": checks}
+
 # Historical Sites Routes
 @api_router.get("/sites", response_model=List[HistoricalSite])
-async def get_historical_sites():
+async def get_historical_sites(request: Request):
     """Get all historical sites"""
     try:
-        sites = await db.historical_sites.find().to_list(length=None)
-        return [HistoricalSite(**parse_from_mongo(site)) for site in sites]
+        return catalog_response(request, await traced("catalog_cache.get", catalog_cache.get()))
     except Exception as e:
-        logging.error(f"Error fetching sites: {e}")
+        logging.error("Error fetching sites: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch historical sites")
 
 @api_router.get("/sites/{site_id}", response_model=HistoricalSite)
-async def get_site(site_id: str):
+async def get_site(site_id: str, request: Request, response: Response):
     """Get a specific historical site"""
     try:
-        site = await db.historical_sites.find_one({"id": site_id})
+        catalog = await traced("catalog_cache.get", catalog_cache.get())
+        site = catalog.by_id.get(site_id)
         if not site:
             raise HTTPException(status_code=404, detail="Site not found")
-        return HistoricalSite(**parse_from_mongo(site))
+        if etag_matches(request, catalog.etag):
+            return Response(status_code=304, headers=catalog.headers)
+        response.headers.update(catalog.headers)
+        return site
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error fetching site {site_id}: {e}")
+        logging.error("Error fetching site %s: %s", site_id, e)
         raise HTTPException(status_code=500, detail="Failed to fetch site")
 
+@api_router.get("/sites/{site_id}/availability", response_model=SiteAvailability)
+async def get_site_availability(
+    site_id: int,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to")
+):
+    """Seats left per time slot of a site between two dates (YYYY-MM-DD, inclusive)
+
+    Defaults to the next AVAILABILITY_DEFAULT_DAYS days and reads only slot_occupancy.
+    """
+    try:
+        first = parse_range_bound(start, "from")[0].date() if start else datetime.now(timezone.utc).date()
+        last = parse_range_bound(end, "to")[0].date() if end else first + timedelta(days=AVAILABILITY_DEFAULT_DAYS - 1)
+        if last < first:
+            raise HTTPException(status_code=400, detail="'to' must not be before 'from'")
+        if (last - first).days >= AVAILABILITY_MAX_DAYS:
+            raise HTTPException(status_code=400, detail=f"At most {AVAILABILITY_MAX_DAYS} days per request")
+
+        capacity, occupied = await asyncio.gather(
+            traced("get_site_capacity", get_site_capacity(site_id)),
+            traced("mongo.slot_occupancy.find", db.slot_occupancy.find(
+                {"site_id": site_id, "date": {"$gte": first.isoformat(), "$lte": last.isoformat()}},
+                {"_id": 0, "date": 1, "time": 1, "booked": 1}
+            ).to_list(length=None))
+        )
+        booked = {(slot["date"], slot["time"]): slot["booked"] for slot in occupied}
+        times = capacity.times or SLOT_TIMES
+        for day in range((last - first).days + 1):
+            date = (first + timedelta(days=day)).isoformat()
+            for slot_time in times:
+                booked.setdefault((date, slot_time), 0)
+
+        return SiteAvailability(site_id=site_id, slot_capacity=capacity.slot_capacity, slots=[
+            SlotAvailability(
+                date=date, time=slot_time, capacity=capacity.slot_capacity, booked=seats,
+                available=max(capacity.slot_capacity - seats, 0)
+            )
+            for (date, slot_time), seats in sorted(booked.items())
+        ])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error fetching availability for site %s: %s", site_id, e)
+        raise HTTPException(status_code=500, detail="Failed to fetch availability")
+
+@api_router.get("/sites/{site_id}/capacity", response_model=SiteCapacity)
+async def get_site_capacity_route(site_id: int):
+    """Get the slot capacity of a site"""
+    try:
+        return await traced("get_site_capacity", get_site_capacity(site_id))
+    except Exception as e:
+        logging.error("Error fetching capacity for site %s: %s", site_id, e)
+        raise HTTPException(status_code=500, detail="Failed to fetch site capacity")
+
+@api_router.put("/sites/{site_id}/capacity", response_model=SiteCapacity)
+async def update_site_capacity(site_id: int, capacity_data: SiteCapacityUpdate):
+    """Set the slot capacity of a site; seats already booked are kept even above the new capacity"""
+    try:
+        capacity = SiteCapacity(site_id=site_id, **capacity_data.dict())
+        await traced("mongo.site_capacity.replace_one", db.site_capacity.replace_one({"site_id": site_id}, capacity.dict(), upsert=True))
+        site_capacity_cache.pop(site_id, None)
+        return capacity
+    except Exception as e:
+        logging.error("Error updating capacity for site %s: %s", site_id, e)
+        raise HTTPException(status_code=500, detail="Failed to update site capacity")
+
 # Booking Routes
 @api_router.post("/bookings", response_model=Booking)
-async def create_booking(booking_data: BookingCreate):
-    """Create a new booking"""
-    try:
+async def create_booking(
+    booking_data: BookingCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Create a new booking; retries with the same Idempotency-Key get the first booking back"""
+    async def create() -> Booking:
         booking = Booking(**booking_data.dict())
-        booking_dict = prepare_for_mongo(booking.dict())
+        booking_dict = booking_codec.encode(booking)
+        slot = (booking.site_id, booking.date, booking.time)
+        if not await traced("reserve_seats", reserve_seats(*slot, booking.group_size)):
+            raise HTTPException(status_code=409, detail="Time slot is full")
         
-        result = await db.bookings.insert_one(booking_dict)
-        if not result.inserted_id:
-            raise HTTPException(status_code=500, detail="Failed to create booking")
+        if BOOKING_WRITE_BUFFER:
+            # Releases the seats itself if the insert fails
+            await traced("booking_write_buffer.insert", booking_write_buffer.insert(booking_dict))
+        else:
+            try:
+                result = await traced("mongo.bookings.insert_one", db.bookings.insert_one(booking_dict))
+            except Exception:
+                await release_seats(*slot, booking.group_size)
+                raise
+            if not result.inserted_id:
+                raise HTTPException(status_code=500, detail="Failed to create booking")
+            await traced("record_bookings_created", record_bookings_created([booking_dict]))
         
         # Log the booking
-        logging.info(f"New booking created: {booking.id} for {booking.site_name}")
+        logging.info("New booking created: %s for %s", booking.id, booking.site_name)
         
         return booking
+
+    try:
+        return await idempotency_store.run("bookings", idempotency_key, booking_data, response, create)
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error creating booking: {e}")
+        logging.error("Error creating booking: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create booking")
 
+@api_router.post("/bookings/bulk", response_model=BulkBookingResponse)
+async def create_bookings_bulk(request: Request):
+    """Create many bookings from a JSON array or an NDJSON body (Content-Type: application/x-ndjson)
+
+    Every item is validated on its own; valid ones take their slot seats and are
+    written with unordered insert_many in chunks of BULK_INSERT_CHUNK_SIZE, and
+    each item gets a status.
+    """
+    try:
+        items = await traced("read_bulk_items", read_bulk_items(request))
+
+        results = []
+        valid = []
+        for index, item in enumerate(items):
+            if isinstance(item, ValueError):
+                results.append(BulkBookingItemResult(index=index, status="invalid", errors=[{"msg": str(item)}]))
+                continue
+            try:
+                booking_data = BookingCreate.model_validate(item)
+            except ValidationError as e:
+                errors = e.errors(include_url=False, include_context=False, include_input=False)
+                results.append(BulkBookingItemResult(index=index, status="invalid", errors=jsonable_encoder(errors)))
+                continue
+            # Already validated as BookingCreate, so skip validating the same fields again
+            booking = Booking.model_construct(**booking_data.dict())
+            results.append(BulkBookingItemResult(index=index, status="created", id=booking.id))
+            valid.append((index, booking_codec.encode(booking)))
+
+        await traced("reserve_bulk_seats", reserve_bulk_seats(valid, results))
+        chunks = [valid[i:i + BULK_INSERT_CHUNK_SIZE] for i in range(0, len(valid), BULK_INSERT_CHUNK_SIZE)]
+        await traced("mongo.bookings.insert_many", asyncio.gather(*(insert_booking_chunk(chunk, results) for chunk in chunks)))
+        await traced("release_seats", asyncio.gather(*(
+            release_seats(document["site_id"], document["date"], document["time"], document["group_size"])
+            for index, document in valid if results[index].status == "failed"
+        )))
+        await traced("record_bookings_created", record_bookings_created(
+            [document for index, document in valid if results[index].status == "created"]
+        ))
+
+        counts = {"created": 0, "invalid": 0, "failed": 0}
+        for result in results:
+            counts[result.status] += 1
+        logging.info("Bulk booking request: %s created, %s invalid, %s failed", counts['created'], counts['invalid'], counts['failed'])
+
+        return BulkBookingResponse(received=len(items), results=results, **counts)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error creating bulk bookings: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to create bookings")
+
 @api_router.get("/bookings", response_model=List[Booking])
-async def get_bookings(user_email: Optional[str] = None):
-    """Get bookings, optionally filtered by user email"""
+async def get_bookings(
+    response: Response,
+    user_email: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(BOOKING_PAGE_SIZE, ge=1, le=BOOKING_MAX_PAGE_SIZE),
+    fields: Optional[str] = None
+):
+    """Get bookings newest first, optionally filtered by user email
+
+    Pages are keyset-based: pass the X-Next-Cursor header of one response as
+    `cursor` to get the next page. `fields` limits the returned fields.
+    """
     try:
-        query = {}
-        if user_email:
-            query["email"] = user_email
-            
-        bookings = await db.bookings.find(query).sort("created_at", -1).to_list(length=100)
-        return [Booking(**parse_from_mongo(booking)) for booking in bookings]
+        projection = booking_projection(fields)
+        query = booking_query(user_email, cursor)
+
+        # One extra document tells us whether there is a next page
+        bookings = await traced(
+            "mongo.bookings.find",
+            db.bookings.find(query, projection).sort(BOOKING_SORT).limit(limit + 1).to_list(length=limit + 1)
+        )
+        headers = {}
+        if len(bookings) > limit:
+            bookings = bookings[:limit]
+            headers["X-Next-Cursor"] = encode_booking_cursor(bookings[-1])
+
+        if projection is not None:
+            # Partial documents cannot be validated as Booking; dump formats them the same way
+            return ORJSONResponse(
+                content=[booking_codec.dump(booking) for booking in bookings],
+                headers=headers
+            )
+        response.headers.update(headers)
+        return [booking_codec.load(booking) for booking in bookings]
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error fetching bookings: {e}")
+        logging.error("Error fetching bookings: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch bookings")
 
+@api_router.get("/bookings/export")
+async def export_bookings(user_email: Optional[str] = None, fields: Optional[str] = None):
+    """Stream all matching bookings as NDJSON, newest first, in constant memory"""
+    projection = booking_projection(fields) or {"_id": 0}
+    query = booking_query(user_email)
+
+    async def generate():
+        mongo_cursor = db.bookings.find(query, projection).sort(BOOKING_SORT).batch_size(BOOKING_EXPORT_BATCH_SIZE)
+        try:
+            async for booking in mongo_cursor:
+                yield orjson.dumps(booking_codec.decode(booking), option=orjson.OPT_APPEND_NEWLINE)
+        except Exception as e:
+            logging.error("Error exporting bookings: %s", e)
+            raise
+        finally:
+            await mongo_cursor.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@api_router.patch("/bookings/status")
+async def update_bookings_status(update: BookingStatusBulkUpdate):
+    """Move many bookings to one status, given by `ids` or by a `filter`
+
+    e.g. {"status": "cancelled", "filter": {"status": "pending", "site_id": 3, "older_than_hours": 48}}.
+    Only transitions in BOOKING_TRANSITIONS are applied; the answer counts the bookings
+    that matched, changed, or stayed cancelled because their slot is full, and for `ids`
+    the ones not found or skipped (already in that status, or not allowed to move).
+    """
+    try:
+        if update.status not in BOOKING_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status")
+        if (update.ids is None) == (update.filter is None):
+            raise HTTPException(status_code=400, detail="Give either ids or filter")
+        if update.ids is not None:
+            if len(update.ids) > BULK_MAX_ITEMS:
+                raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} ids per request")
+            query = {"id": {"$in": update.ids}}
+        else:
+            query = booking_status_filter_query(update.filter, update.status)
+
+        counts = await traced("transition_bookings", transition_bookings(query, update.status))
+        if update.ids is not None:
+            existing = await traced("mongo.bookings.count_documents", db.bookings.count_documents(query))
+            counts["not_found"] = len(set(update.ids)) - existing
+            counts["skipped"] = existing - counts["matched"]
+        logging.info("Bulk status change to %s: %s", update.status, counts)
+        return {"status": update.status, **counts}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error updating booking statuses: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to update booking statuses")
+
 @api_router.get("/bookings/{booking_id}", response_model=Booking)
 async def get_booking(booking_id: str):
     """Get a specific booking"""
     try:
-        booking = await db.bookings.find_one({"id": booking_id})
+        booking = await traced("mongo.bookings.find_one", db.bookings.find_one({"id": booking_id}))
         if not booking:
             raise HTTPException(status_code=404, detail="Booking not found")
-        return Booking(**parse_from_mongo(booking))
+        return booking_codec.load(booking)
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error fetching booking {booking_id}: {e}")
+        logging.error("Error fetching booking %s: %s", booking_id, e)
         raise HTTPException(status_code=500, detail="Failed to fetch booking")
 
 @api_router.put("/bookings/{booking_id}/status")
@@ -209,38 +3004,37 @@ async def update_booking_status(booking_id: str, status: str):
         if status not in ["pending", "confirmed", "cancelled"]:
             raise HTTPException(status_code=400, detail="Invalid status")
             
-        result = await db.bookings.update_one(
-            {"id": booking_id},
-            {"$set": {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
-        
-        if result.matched_count == 0:
+        previous = await traced("set_booking_status", set_booking_status(booking_id, status))
+        if previous is None:
             raise HTTPException(status_code=404, detail="Booking not found")
             
         return {"message": f"Booking status updated to {status}"}
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error updating booking status: {e}")
+        logging.error("Error updating booking status: %s", e)
         raise HTTPException(status_code=500, detail="Failed to update booking status")
 
 # Payment Routes
 @api_router.post("/payments/checkout/session", response_model=CheckoutSessionResponse)
-async def create_checkout_session(payment_request: PaymentRequest, request: Request):
-    """Create a Stripe checkout session for a booking"""
-    try:
+async def create_checkout_session(
+    payment_request: PaymentRequest,
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Create a Stripe checkout session for a booking; retries with the same Idempotency-Key never reach Stripe again"""
+    async def create() -> CheckoutSessionResponse:
         # Get the booking details
-        booking = await db.bookings.find_one({"id": payment_request.booking_id})
+        booking = await traced("mongo.bookings.find_one", db.bookings.find_one({"id": payment_request.booking_id}))
         if not booking:
             raise HTTPException(status_code=404, detail="Booking not found")
         
         if booking.get("status") != "pending":
             raise HTTPException(status_code=400, detail="Booking is not in pending status")
         
-        # Initialize Stripe checkout
         host_url = str(request.base_url).rstrip('/')
         webhook_url = f"{host_url}/api/webhook/stripe"
-        stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
         
         # Create checkout session request
         amount = float(booking["total_price"])
@@ -251,7 +3045,7 @@ async def create_checkout_session(payment_request: PaymentRequest, request: Requ
             "group_size": str(booking["group_size"])
         }
         
-        checkout_request = CheckoutSessionRequest(
+        checkout_request = stripe_checkout_module().CheckoutSessionRequest(
             amount=amount,
             currency="usd",
             success_url=payment_request.success_url,
@@ -260,7 +3054,7 @@ async def create_checkout_session(payment_request: PaymentRequest, request: Requ
         )
         
         # Create the checkout session
-        session = await stripe_checkout.create_checkout_session(checkout_request)
+        session = await payment_client.create_checkout_session(webhook_url, checkout_request)
         
         # Store payment transaction
         payment_transaction = PaymentTransaction(
@@ -273,63 +3067,69 @@ async def create_checkout_session(payment_request: PaymentRequest, request: Requ
             payment_status="pending"
         )
         
-        transaction_dict = prepare_for_mongo(payment_transaction.dict())
-        await db.payment_transactions.insert_one(transaction_dict)
+        transaction_dict = payment_transaction_codec.encode(payment_transaction)
+        await traced("mongo.payment_transactions.insert_one", db.payment_transactions.insert_one(transaction_dict))
         
-        logging.info(f"Payment session created: {session.session_id} for booking {payment_request.booking_id}")
+        logging.info("Payment session created: %s for booking %s", session.session_id, payment_request.booking_id)
         
         return session
+
+    try:
+        return await idempotency_store.run("checkout_sessions", idempotency_key, payment_request, response, create)
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error creating checkout session: {e}")
+        logging.error("Error creating checkout session: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create checkout session")
 
 @api_router.get("/payments/checkout/status/{session_id}", response_model=CheckoutStatusResponse)
 async def get_checkout_status(session_id: str):
     """Get the status of a checkout session"""
     try:
-        # Initialize Stripe checkout
-        webhook_url = ""  # Not needed for status check
-        stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
-        
-        # Get checkout status from Stripe
-        status_response = await stripe_checkout.get_checkout_status(session_id)
-        
-        # Update payment transaction status
-        transaction = await db.payment_transactions.find_one({"session_id": session_id})
-        if transaction:
-            update_data = {
-                "payment_status": status_response.payment_status,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            await db.payment_transactions.update_one(
-                {"session_id": session_id},
-                {"$set": update_data}
-            )
-            
-            # If payment is successful, update booking status
-            if status_response.payment_status == "paid" and transaction.get("payment_status") != "paid":
-                await db.bookings.update_one(
-                    {"id": transaction["booking_id"]},
-                    {"$set": {"status": "confirmed", "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                logging.info(f"Booking {transaction['booking_id']} confirmed via payment {session_id}")
-        
-        return status_response
+        # Served from the status cache; Stripe is asked at most once per CHECKOUT_STATUS_TTL
+        return await traced("checkout_status_cache.get", checkout_status_cache.get(session_id, fetch_checkout_status))
     except Exception as e:
-        logging.error(f"Error checking checkout status: {e}")
+        logging.error("Error checking checkout status: %s", e)
         raise HTTPException(status_code=500, detail="Failed to check checkout status")
 
+@api_router.get("/payments/checkout/events/{session_id}")
+async def checkout_status_events(session_id: str, request: Request):
+    """Server-Sent Events stream of a checkout's payment status, replacing status polling
+
+    Sends the current status straight away, then one `status` event per change,
+    and closes once the payment is paid, expired or failed.
+    """
+    async def stream():
+        async for event in payment_status_events(session_id, request.is_disconnected):
+            if event is None:
+                yield b": keep-alive\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(event)}\n\n".encode()
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # stop nginx from buffering the stream
+    })
+
+@api_router.websocket("/payments/checkout/ws/{session_id}")
+async def checkout_status_websocket(websocket: WebSocket, session_id: str):
+    """WebSocket variant of the checkout status events, one JSON message per change"""
+    await websocket.accept()
+    try:
+        async for event in payment_status_events(session_id):
+            if event is None:
+                await websocket.send_json({"type": "heartbeat"})
+            else:
+                await websocket.send_json({"type": "status", **event})
+        await websocket.close()
+    except (WebSocketDisconnect, RuntimeError):
+        # Client went away mid-stream
+        pass
+
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
     """Handle Stripe webhook events"""
     try:
-        # Initialize Stripe checkout
-        webhook_url = ""  # Not needed for webhook handling
-        stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
-        
         # Get request body and signature
         body = await request.body()
         signature = request.headers.get("Stripe-Signature")
@@ -337,34 +3137,18 @@ async def stripe_webhook(request: Request):
         if not signature:
             raise HTTPException(status_code=400, detail="Missing Stripe signature")
         
-        # Handle webhook
-        webhook_response = await stripe_checkout.handle_webhook(body, signature)
-        
-        # Update payment transaction based on webhook event
-        if webhook_response.session_id:
-            transaction = await db.payment_transactions.find_one({"session_id": webhook_response.session_id})
-            if transaction:
-                update_data = {
-                    "payment_status": webhook_response.payment_status,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-                
-                await db.payment_transactions.update_one(
-                    {"session_id": webhook_response.session_id},
-                    {"$set": update_data}
-                )
-                
-                # If payment is successful, update booking status
-                if webhook_response.payment_status == "paid" and transaction.get("payment_status") != "paid":
-                    await db.bookings.update_one(
-                        {"id": transaction["booking_id"]},
-                        {"$set": {"status": "confirmed", "updated_at": datetime.now(timezone.utc).isoformat()}}
-                    )
-                    logging.info(f"Booking {transaction['booking_id']} confirmed via webhook {webhook_response.session_id}")
+        # Verify the signature, then queue the event; the inbox workers apply it
+        webhook_response = await payment_client.handle_webhook(body, signature)
+        if not await traced("webhook_inbox.enqueue", webhook_inbox.enqueue(webhook_response, body)):
+            logging.info("Duplicate Stripe event %s ignored", webhook_response.event_id)
         
         return {"status": "success"}
+    except PyMongoError as e:
+        # Not stored, so let Stripe deliver it again
+        logging.error("Error storing Stripe webhook: %s", e)
+        raise HTTPException(status_code=503, detail="Webhook could not be stored")
     except Exception as e:
-        logging.error(f"Error handling Stripe webhook: {e}")
+        logging.error("Error handling Stripe webhook: %s", e)
         raise HTTPException(status_code=400, detail="Webhook handling failed")
 
 # User Routes
@@ -373,14 +3157,14 @@ async def create_user(user_data: UserCreate):
     """Create a new user"""
     try:
         # Check if user already exists
-        existing_user = await db.users.find_one({"email": user_data.email})
+        existing_user = await traced("mongo.users.find_one", db.users.find_one({"email": user_data.email}))
         if existing_user:
             raise HTTPException(status_code=400, detail="User with this email already exists")
         
         user = User(**user_data.dict())
-        user_dict = prepare_for_mongo(user.dict())
+        user_dict = user_codec.encode(user)
         
-        result = await db.users.insert_one(user_dict)
+        result = await traced("mongo.users.insert_one", db.users.insert_one(user_dict))
         if not result.inserted_id:
             raise HTTPException(status_code=500, detail="Failed to create user")
         
@@ -388,52 +3172,153 @@ async def create_user(user_data: UserCreate):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error creating user: {e}")
+        logging.error("Error creating user: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create user")
 
 @api_router.get("/users/{email}", response_model=User)
 async def get_user(email: str):
     """Get user by email"""
     try:
-        user = await db.users.find_one({"email": email})
+        user = await traced("mongo.users.find_one", db.users.find_one({"email": email}))
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
-        return User(**parse_from_mongo(user))
+        return user_codec.load(user)
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error fetching user {email}: {e}")
+        logging.error("Error fetching user %s: %s", email, e)
         raise HTTPException(status_code=500, detail="Failed to fetch user")
 
 # Analytics Routes
 @api_router.get("/analytics/bookings")
-async def get_booking_analytics():
-    """Get booking analytics"""
+async def get_booking_analytics(live: bool = False):
+    """Get booking analytics
+
+    Reads the materialized counters; `live=true` (or counters that were never
+    reconciled) computes them with a single aggregation over bookings instead.
+    """
     try:
-        total_bookings = await db.bookings.count_documents({})
-        pending_bookings = await db.bookings.count_documents({"status": "pending"})
-        confirmed_bookings = await db.bookings.count_documents({"status": "confirmed"})
-        
-        # Most popular sites
-        pipeline = [
-            {"$group": {"_id": "$site_name", "count": {"$sum": 1}, "total_revenue": {"$sum": "$total_price"}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        popular_sites = await db.bookings.aggregate(pipeline).to_list(length=5)
-        
+        if not live:
+            counters, popular_sites = await asyncio.gather(
+                traced("mongo.booking_counters.find_one", analytics_db.booking_counters.find_one({"_id": BOOKING_COUNTERS_ID})),
+                traced("mongo.booking_site_stats.find", analytics_db.booking_site_stats.find().sort("count", -1).limit(5).to_list(length=5))
+            )
+            if counters and counters.get("reconciled_at"):
+                return booking_analytics_response(counters, popular_sites)
+
+        counters, popular_sites = await traced(
+            "mongo.bookings.aggregate", aggregate_booking_analytics(site_limit=5, database=analytics_db)
+        )
+        return booking_analytics_response(counters, popular_sites)
+    except Exception as e:
+        logging.error("Error fetching analytics: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to fetch analytics")
+
+@api_router.get("/analytics/bookings/timeseries")
+async def get_booking_timeseries(
+    granularity: str = Query("day", pattern="^(day|hour)$"),
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    site_id: Optional[int] = None,
+    status: Optional[str] = None
+):
+    """Bookings and revenue per day or hour, read from the pre-aggregated rollups
+
+    `from`/`to` accept ISO dates or datetimes (UTC); a bare `to` date is inclusive.
+    Defaults to the last 30 days, or the last 48 hours for hourly buckets.
+    """
+    try:
+        step = ROLLUP_GRANULARITIES[granularity]
+        now = datetime.now(timezone.utc)
+        if end:
+            end_at, whole_day = parse_range_bound(end, "to")
+            if whole_day:
+                end_at += timedelta(days=1)
+        else:
+            end_at = rollup_bucket(now, granularity) + step
+        if start:
+            start_at, _ = parse_range_bound(start, "from")
+        else:
+            start_at = end_at - (timedelta(days=30) if granularity == "day" else timedelta(hours=48))
+        start_at = rollup_bucket(start_at, granularity)
+        if end_at <= start_at:
+            raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+        if (end_at - start_at) / step > ROLLUP_MAX_BUCKETS[granularity]:
+            raise HTTPException(status_code=400, detail=f"Range too large for {granularity} buckets")
+
+        filtered = site_id is not None or status is not None
+        projection = {"_id": 0, "bucket": 1, "count": 1, "revenue": 1}
+        if filtered:
+            projection["cells"] = 1
+        rollups = await traced("mongo.booking_rollups.find", analytics_db.booking_rollups.find(
+            {"granularity": granularity, "bucket": {"$gte": start_at, "$lt": end_at}}, projection
+        ).to_list(length=None))
+
+        values = {}
+        for rollup in rollups:
+            if filtered:
+                count, revenue = 0, 0.0
+                for cell, totals in rollup.get("cells", {}).items():
+                    cell_site, _, cell_status = cell.partition("|")
+                    if site_id is not None and cell_site != str(site_id):
+                        continue
+                    if status is not None and cell_status != status:
+                        continue
+                    count += totals.get("count", 0)
+                    revenue += totals.get("revenue", 0)
+            else:
+                count, revenue = rollup.get("count", 0), rollup.get("revenue", 0)
+            values[rollup_bucket(rollup["bucket"], granularity)] = (count, revenue)
+
+        buckets = []
+        bucket = start_at
+        while bucket < end_at:
+            count, revenue = values.get(bucket, (0, 0.0))
+            buckets.append({"bucket": bucket.isoformat(), "count": count, "revenue": round(revenue, 2)})
+            bucket += step
+
         return {
-            "total_bookings": total_bookings,
-            "pending_bookings": pending_bookings,
-            "confirmed_bookings": confirmed_bookings,
-            "popular_sites": popular_sites
+            "granularity": granularity,
+            "from": start_at.isoformat(),
+            "to": end_at.isoformat(),
+            "site_id": site_id,
+            "status": status,
+            "total_bookings": sum(item["count"] for item in buckets),
+            "total_revenue": round(sum(item["revenue"] for item in buckets), 2),
+            "buckets": buckets
         }
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error fetching analytics: {e}")
-        raise HTTPException(status_code=500, detail="Failed to fetch analytics")
+        logging.error("Error fetching booking timeseries: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to fetch booking timeseries")
+
+@api_router.post("/analytics/bookings/reconcile")
+async def reconcile_booking_analytics():
+    """Rebuild the booking analytics counters from the bookings collection"""
+    try:
+        counters = await traced("reconcile_booking_counters", reconcile_booking_counters())
+        popular_sites = await traced(
+            "mongo.booking_site_stats.find", db.booking_site_stats.find().sort("count", -1).limit(5).to_list(length=5)
+        )
+        return booking_analytics_response(counters, popular_sites)
+    except Exception as e:
+        logging.error("Error reconciling analytics: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to reconcile analytics")
+
+@api_router.get("/diagnostics/indexes")
+async def get_index_report():
+    """Outcome of the last index sync: indexes created, drift from the registry and route queries that COLLSCAN"""
+    return jsonable_encoder(index_manager.report)
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Request, Mongo and Stripe latency in Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Include the router in the main app
 app.include_router(api_router)
+preallocate_route_metrics(app.routes)
 
 # Middleware
 app.add_middleware(
@@ -442,35 +3327,90 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", REQUEST_ID_HEADER, "Server-Timing", "Idempotent-Replayed"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(RequestContextMiddleware)
+# Outermost, so the latency includes CORS handling
+app.add_middleware(RequestMetricsMiddleware)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Logging is configured at the top of the module, before the first record
 logger = logging.getLogger(__name__)
 
-@app.on_event("startup")
 async def startup_event():
-    """Initialize the application"""
+    """Initialize the application; nothing here waits for the database, warm_up does that in the background"""
     logger.info("Starting Madinah Ziyarat API")
-    
-    # Create indexes for better performance
-    try:
-        await db.bookings.create_index("email")
-        await db.bookings.create_index("created_at")
-        await db.bookings.create_index("status")
-        await db.users.create_index("email", unique=True)
-        await db.payment_transactions.create_index("session_id", unique=True)
-        await db.payment_transactions.create_index("booking_id")
-        await db.payment_transactions.create_index("user_email")
-        logger.info("Database indexes created successfully")
+    connect_mongo()
+
+    # Build missing indexes in the background; serving does not wait for them
+    start_background_task(index_manager.run())
+    if payment_events.backend == "mongo":
+        start_background_task(payment_events.watch())
+    for worker_id in range(WEBHOOK_WORKERS):
+        start_background_task(webhook_inbox.run_worker(worker_id))
+    start_background_task(warm_up())
+    if BOOKING_COUNTERS_RECONCILE_INTERVAL > 0:
+        start_background_task(run_periodically(
+            "reconcile_booking_counters", BOOKING_COUNTERS_RECONCILE_INTERVAL, reconcile_booking_counters
+        ))
+    if EXPIRY_SWEEP_INTERVAL > 0:
+        start_background_task(run_periodically("expiry_sweep", EXPIRY_SWEEP_INTERVAL, expiry_sweeper.run))
+
+async def warm_up():
+    """Startup work that needs the database; /api/ready reports ready once it is done"""
+    global payment_transactions_enabled, app_ready
+    if PAYMENT_CONFIRMATION_MODE == "transaction":
+        payment_transactions_enabled = True
+    elif PAYMENT_CONFIRMATION_MODE == "auto":
+        try:
+            payment_transactions_enabled = await detect_transaction_support()
+        except Exception as e:
+            logger.error("Error detecting transaction support: %s", e)
+    logger.info("Payment confirmations use %s", 'transactions' if payment_transactions_enabled else 'the outbox')
+    if not payment_transactions_enabled:
+        start_background_task(run_periodically(
+            "recover_payment_confirmations", max(PAYMENT_OUTBOX_GRACE_SECONDS, PAYMENT_OUTBOX_MIN_INTERVAL),
+            recover_payment_confirmations
+        ))
+
+    # Warm the catalog cache so the first visitor does not pay for the load
+    try:
+        await catalog_cache.get()
+    except Exception as e:
+        logger.error("Error warming catalog cache: %s", e)
+    if CATALOG_CHANGE_STREAM:
+        catalog_cache.start_watching()
+
+    # Build the analytics counters once if they have never been reconciled, then keep them honest
+    try:
+        counters = await db.booking_counters.find_one({"_id": BOOKING_COUNTERS_ID})
+        if not counters or not counters.get("reconciled_at"):
+            start_background_task(reconcile_booking_counters())
+    except Exception as e:
+        logger.error("Error checking booking counters: %s", e)
+    # Seed slot occupancy from existing bookings the first time capacity is enforced
+    try:
+        if not await db.slot_occupancy.find_one({}, {"_id": 1}) and await db.bookings.find_one({}, {"_id": 1}):
+            start_background_task(rebuild_slot_occupancy())
     except Exception as e:
-        logger.error(f"Error creating indexes: {e}")
+        logger.error("Error checking slot occupancy: %s", e)
+    app_ready = True
+    logger.info("Madinah Ziyarat API ready")
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+async def shutdown_event():
     """Clean up database connection"""
-    client.close()
+    global app_ready
+    app_ready = False
+    await booking_write_buffer.close()
+    await catalog_cache.stop_watching()
+    await stop_background_tasks()
+    if EXPIRY_SWEEP_INTERVAL > 0:
+        # Let another worker take over the sweeps without waiting for the lease to lapse
+        try:
+            await expiry_sweeper.lease.release()
+        except Exception as e:
+            logger.error("Error releasing the expiry sweeper lease: %s", e)
+    await payment_client.close()
+    close_mongo()
     logger.info("Database connection closed")
\ No newline at end of file
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the Madinah Ziyarat backend
+Runs in-process against backend/server.py, no database or network needed
+
+Usage: python backend_benchmark.py [benchmark ...]
+"""
+
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# server.py reads these at import time; the benchmarks never touch Mongo
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "madinah_benchmark")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from typing import List  # noqa: E402
+
+
+def sample_site_documents(count=12):
+    """Mongo documents shaped like the real historical_sites catalog"""
+    return [
+        {
+            "_id": f"{i:024x}",
+            "id": f"site-{i}",
+            "name": f"Historical Site {i}",
+            "name_arabic": "مسجد قباء",
+            "description": "The first mosque built in Islam, established by the Prophet upon arrival in Madinah. " * 3,
+            "significance": "Praying two rak'ahs here carries the reward of an Umrah.",
+            "duration": "1-2 hours",
+            "distance": "3.5 km from Masjid an-Nabawi",
+            "image": f"https://images.example.com/sites/{i}.jpg",
+            "price": 120.0 + i,
+            "rating": 4.8,
+            "created_at": "2024-09-01T08:00:00+00:00",
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_parse_from_mongo(item):
+    """The heuristic decoder server.py used before the schema-driven codecs"""
+    if isinstance(item, dict):
+        for key, value in item.items():
+            if isinstance(value, str) and 'T' in value:
+                try:
+                    item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                except ValueError:
+                    pass
+    return item
+
+
+def sample_booking_documents(count=1000, native_dates=True):
+    """Mongo booking documents, with created_at as a BSON date or as a legacy ISO string"""
+    created_at = datetime(2024, 9, 1, 8, 0, tzinfo=timezone.utc)
+    return [
+        {
+            "_id": f"{i:024x}",
+            "id": f"booking-{i}",
+            "name": "Test Traveller",
+            "email": f"traveller{i}@example.com",
+            "phone": "+966500000000",
+            "site_id": 1,
+            "site_name": "Tour of Masjid Quba",
+            "group_size": 2,
+            "date": "2024-09-30",
+            "time": "10:00",
+            "special_requests": "Transport from The Oberoi hotel",
+            "total_price": 240.0,
+            "booking_type": "contact",
+            "status": "pending",
+            "created_at": created_at if native_dates else created_at.isoformat(),
+        }
+        for i in range(count)
+    ]
+
+
+def make_request(accept_encoding="gzip, deflate, br"):
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding else []
+    return Request({"type": "http", "method": "GET", "path": "/api/sites", "headers": headers})
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """Just enough of the Stripe Checkout Sessions API for benchmarks and load tests"""
+    protocol_version = "HTTP/1.1"  # keep-alive, like api.stripe.com
+    # One write per response, otherwise Nagle + delayed ACK add ~40 ms to every reused connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        # Stand-in for the TCP + TLS handshake cost of a fresh connection to Stripe
+        time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session(self, session_id):
+        return {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+            "status": self.server.sessions.get(session_id, "open"),
+            "payment_status": "paid" if self.server.sessions.get(session_id) == "complete" else "unpaid",
+            "amount_total": 24000,
+            "currency": "usd",
+            "metadata": {},
+        }
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        prefix = "/v1/checkout/sessions/"
+        if not self.path.startswith(prefix):
+            return self.send_json({"error": {"message": "Not found"}}, status=404)
+        self.send_json(self.session(self.path[len(prefix):].split("?")[0]))
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/v1/checkout/sessions":
+            return self.send_json({"error": {"message": "Not found"}}, status=404)
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        self.server.sessions[session_id] = "open"
+        self.send_json(self.session(session_id))
+
+
+class FakeStripeServer:
+    """Local HTTP server answering like Stripe; point stripe.api_base at .url"""
+
+    def __init__(self, latency=0.0, handshake_delay=0.0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeStripeHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.handshake_delay = handshake_delay
+        self.httpd.sessions = {}
+        self.httpd.connections = 0
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    def complete(self, session_id):
+        self.httpd.sessions[session_id] = "complete"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def latency_summary(samples):
+    """p50/p95/p99 in milliseconds"""
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000  # noqa: E731
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "mean": statistics.fmean(ordered) * 1000}
+
+
+class MadinahToursBenchmark:
+    def __init__(self, iterations=5000):
+        self.iterations = iterations
+        self.results = {}
+
+    def timed(self, name, func):
+        """Run func `iterations` times and record microseconds per call"""
+        func()  # warm up
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            func()
+        elapsed = time.perf_counter() - start
+        per_call = elapsed / self.iterations * 1e6
+        self.results[name] = per_call
+        print(f"   {name:<45} {per_call:10.2f} µs/call")
+        return per_call
+
+    def bench_catalog_serialization(self):
+        """Compare the response_model path with the cached and pre-serialized catalog paths"""
+        print("\n=== CATALOG SERIALIZATION ===")
+        documents = sample_site_documents()
+        field = create_response_field(name="Response_get_historical_sites", type_=List[server.HistoricalSite])
+        loop = asyncio.new_event_loop()
+
+        def response_model_path():
+            # What get_historical_sites did before the catalog cache: parse, construct, validate, encode
+            sites = [server.HistoricalSite(**legacy_parse_from_mongo(dict(doc))) for doc in documents]
+            content = loop.run_until_complete(serialize_response(field=field, response_content=sites, is_coroutine=True))
+            return JSONResponse(content=content).body
+
+        snapshot = server.CatalogSnapshot(
+            [server.site_codec.load(dict(doc)) for doc in documents],
+            expires_at=float("inf")
+        )
+
+        def cached_payload_path():
+            return JSONResponse(content=snapshot.payload, headers=snapshot.headers).body
+
+        request = make_request()
+
+        def preserialized_path():
+            return server.catalog_response(request, snapshot).body
+
+        baseline = self.timed("response_model (validate + encode)", response_model_path)
+        self.timed("cached payload (encode only)", cached_payload_path)
+        fastest = self.timed("pre-serialized bytes", preserialized_path)
+        loop.close()
+
+        print(f"   Speed-up vs response_model: {baseline / fastest:.1f}x")
+        for encoding, (body, _) in snapshot.encoded.items():
+            print(f"   {encoding:<10} {len(body):8d} bytes")
+
+    def bench_booking_decode(self):
+        """Decode cost per 1k bookings: heuristic string parsing vs the schema-driven codec"""
+        print("\n=== BOOKING DECODE (per 1k bookings) ===")
+        legacy_documents = sample_booking_documents(native_dates=False)
+        native_documents = sample_booking_documents(native_dates=True)
+        iterations, self.iterations = self.iterations, max(1, self.iterations // 100)
+
+        def legacy_decode():
+            return [legacy_parse_from_mongo(dict(doc)) for doc in legacy_documents]
+
+        def codec_decode():
+            return [server.booking_codec.decode(dict(doc)) for doc in native_documents]
+
+        def legacy_load():
+            return [server.Booking(**legacy_parse_from_mongo(dict(doc))) for doc in legacy_documents]
+
+        def codec_load():
+            return [server.booking_codec.load(dict(doc)) for doc in native_documents]
+
+        before = self.timed("parse_from_mongo (decode only)", legacy_decode)
+        after = self.timed("booking_codec.decode", codec_decode)
+        self.timed("parse_from_mongo + Booking(**doc)", legacy_load)
+        self.timed("booking_codec.load", codec_load)
+        self.iterations = iterations
+        print(f"   Decode speed-up: {before / after:.1f}x")
+
+    def bench_wire(self):
+        """Encoding cost and bytes on the wire per request: json vs orjson, then br/gzip as the middleware does it"""
+        print("\n=== RESPONSE ENCODING AND WIRE SIZE (per request) ===")
+        payloads = {
+            "/api/bookings": (List[server.Booking],
+                              [server.booking_codec.load(doc) for doc in sample_booking_documents(server.BOOKING_PAGE_SIZE)]),
+            "/api/sites": (List[server.HistoricalSite],
+                           [server.site_codec.load(dict(doc)) for doc in sample_site_documents()]),
+        }
+        iterations, self.iterations = self.iterations, max(1, self.iterations // 10)
+        loop = asyncio.new_event_loop()
+        for path, (type_, content) in payloads.items():
+            field = create_response_field(name=f"Response_{path.replace('/', '_')}", type_=type_)
+
+            def serialize(field=field, content=content):
+                return loop.run_until_complete(serialize_response(field=field, response_content=content, is_coroutine=True))
+
+            before = self.timed(f"{path} JSONResponse", lambda: JSONResponse(content=serialize()).body)
+            after = self.timed(f"{path} ORJSONResponse", lambda: server.ORJSONResponse(content=serialize()).body)
+            body = server.ORJSONResponse(content=serialize()).body
+            sizes = {"identity": len(body)}
+            for encoding in server.COMPRESSION_ENCODINGS[:-1]:
+                self.timed(f"{path} + {encoding}",
+                           lambda encoding=encoding: server.StreamCompressor(encoding).compress(body, final=True))
+                sizes[encoding] = len(server.StreamCompressor(encoding).compress(body, final=True))
+            self.results[f"{path} bytes"] = sizes
+            print(f"   {path} encoding speed-up {before / after:.1f}x, bytes: "
+                  + ", ".join(f"{encoding} {size}" for encoding, size in sizes.items()))
+        loop.close()
+        self.iterations = iterations
+
+    def bench_stripe_client(self):
+        """Per-call StripeCheckout + fresh HTTP client vs the shared, pooled PaymentClient"""
+        print("\n=== STRIPE CLIENT REUSE (fake Stripe server) ===")
+        stripe = server.stripe_sdk()
+        if stripe is None:
+            print("   ⚠️  stripe/requests not installed, skipping")
+            return
+
+        handshake_ms = float(os.environ.get("FAKE_STRIPE_HANDSHAKE_MS", "20"))
+        calls = max(20, self.iterations // 50)
+        print(f"   {calls} status calls per variant, simulated handshake {handshake_ms:.0f} ms per new connection")
+
+        async def measure(label, call):
+            samples = []
+            for _ in range(calls):
+                start = time.perf_counter()
+                await call()
+                samples.append(time.perf_counter() - start)
+            return samples
+
+        async def run(fake):
+            stripe.api_base = fake.url
+            stripe.api_key = "sk_test_benchmark"
+            session = await asyncio.to_thread(stripe.checkout.Session.create, mode="payment", success_url="https://x", cancel_url="https://x")
+
+            async def fresh_client_call():
+                # What each handler did before: new StripeCheckout, nothing shared
+                stripe.default_http_client = stripe.RequestsClient(timeout=server.STRIPE_TIMEOUT)
+                checkout = server.stripe_checkout_module().StripeCheckout(api_key=stripe.api_key, webhook_url="")
+                await checkout.get_checkout_status(session.id)
+                await asyncio.to_thread(stripe.checkout.Session.retrieve, session.id)
+                stripe.default_http_client.close()
+
+            async def pooled_client_call():
+                await server.payment_client.get_checkout_status(session.id)
+                await asyncio.to_thread(stripe.checkout.Session.retrieve, session.id)
+
+            before = fake.connections
+            fresh = await measure("fresh", fresh_client_call)
+            fresh_connections = fake.connections - before
+            stripe.default_http_client = None
+
+            server.payment_client.start()
+            before = fake.connections
+            pooled = await measure("pooled", pooled_client_call)
+            pooled_connections = fake.connections - before
+            await server.payment_client.close()
+            return (fresh, fresh_connections), (pooled, pooled_connections)
+
+        with FakeStripeServer(handshake_delay=handshake_ms / 1000) as fake:
+            (fresh, fresh_connections), (pooled, pooled_connections) = asyncio.run(run(fake))
+
+        for label, samples, connections in (("new client per call", fresh, fresh_connections),
+                                            ("shared PaymentClient", pooled, pooled_connections)):
+            summary = latency_summary(samples)
+            self.results[label] = summary
+            print(f"   {label:<25} p50 {summary['p50']:7.2f} ms  p95 {summary['p95']:7.2f} ms  "
+                  f"connections opened: {connections}")
+
+    def bench_startup(self):
+        """Cold start: `import server` in a fresh interpreter, and uvicorn launch to first answered request"""
+        print("\n=== STARTUP (fresh processes) ===")
+        backend = Path(__file__).parent / "backend"
+        env = {**os.environ, "LOG_LEVEL": "WARNING"}
+        runs = int(os.environ.get("STARTUP_RUNS", "5"))
+
+        def import_seconds(module):
+            code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+            output = subprocess.run([sys.executable, "-c", code], cwd=backend, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            return float(output.split()[-1])
+
+        for label, module in (("import server", "server"),
+                              ("import Stripe integration", "emergentintegrations.payments.stripe.checkout")):
+            try:
+                seconds = statistics.median(import_seconds(module) for _ in range(runs))
+            except subprocess.CalledProcessError:
+                print(f"   {label:<45} failed")
+                continue
+            self.results[label] = seconds
+            print(f"   {label:<45} {seconds * 1000:10.1f} ms (median of {runs})")
+
+        def first_answer(process, port, path, deadline):
+            while time.perf_counter() < deadline and process.poll() is None:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=1) as response:
+                        return response.status
+                except urllib.error.HTTPError as e:
+                    if path == "/api/health":
+                        return e.code
+                except OSError:
+                    pass
+                time.sleep(0.01)
+            return None
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+            cwd=backend, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            for label, path in (("first request (/api/health)", "/api/health"), ("ready (/api/ready)", "/api/ready")):
+                if first_answer(process, port, path, start + 30) is None:
+                    reason = "uvicorn exited" if process.poll() is not None else "no answer within 30 s"
+                    print(f"   {label:<45} {reason}")
+                    continue
+                seconds = time.perf_counter() - start
+                self.results[label] = seconds
+                print(f"   {label:<45} {seconds * 1000:10.1f} ms after launch")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+BENCHMARKS = {
+    "catalog": MadinahToursBenchmark.bench_catalog_serialization,
+    "decode": MadinahToursBenchmark.bench_booking_decode,
+    "wire": MadinahToursBenchmark.bench_wire,
+    "stripe": MadinahToursBenchmark.bench_stripe_client,
+    "startup": MadinahToursBenchmark.bench_startup,
+}
+
+
+def main():
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(BENCHMARKS)}")
+        return 1
+
+    print("🚀 Madinah Ziyarat backend micro-benchmarks")
+    print("=" * 60)
+    bench = MadinahToursBenchmark(iterations=int(os.environ.get("BENCH_ITERATIONS", "5000")))
+    for name in selected:
+        BENCHMARKS[name](bench)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
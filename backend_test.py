@@ -1,8 +1,11 @@
+import base64
 import requests
 import sys
 import json
 from datetime import datetime, timedelta
+import random
 import time
+import uuid
 
 class MadinahToursAPITester:
     def __init__(self, base_url="https://madina-tours.preview.emergentagent.com"):
@@ -12,11 +15,12 @@ class MadinahToursAPITester:
         self.tests_passed = 0
         self.booking_id = None
         self.session_id = None
+        self.last_response = None
 
-    def run_test(self, name, method, endpoint, expected_status, data=None, params=None):
+    def run_test(self, name, method, endpoint, expected_status, data=None, params=None, extra_headers=None):
         """Run a single API test"""
         url = f"{self.api_url}/{endpoint}"
-        headers = {'Content-Type': 'application/json'}
+        headers = {'Content-Type': 'application/json', **(extra_headers or {})}
 
         self.tests_run += 1
         print(f"\n🔍 Testing {name}...")
@@ -29,6 +33,9 @@ class MadinahToursAPITester:
                 response = requests.post(url, json=data, headers=headers)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers, params=params)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers)
+            self.last_response = response
 
             success = response.status_code == expected_status
             if success:
@@ -53,6 +60,31 @@ class MadinahToursAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, {}
 
+    def check_counts(self, name, response_data, expected):
+        """Check the counts a successful response reported"""
+        self.tests_run += 1
+        print(f"\n🔍 Checking {name}...")
+        actual = {key: response_data.get(key) for key in expected}
+        if actual == expected:
+            self.tests_passed += 1
+            print(f"✅ Passed - {actual}")
+            return True
+        print(f"❌ Failed - Expected {expected}, got {actual}")
+        return False
+
+    def check_page_order(self, name, bookings):
+        """Check that bookings from consecutive pages never repeat and run newest first"""
+        self.tests_run += 1
+        print(f"\n🔍 Checking {name}...")
+        ids = [booking["id"] for booking in bookings]
+        keys = [(datetime.fromisoformat(booking["created_at"].replace("Z", "+00:00")), booking["id"]) for booking in bookings]
+        if len(set(ids)) == len(ids) and keys == sorted(keys, reverse=True):
+            self.tests_passed += 1
+            print(f"✅ Passed - {len(ids)} bookings in (created_at, id) descending order")
+            return True
+        print(f"❌ Failed - ids {ids}")
+        return False
+
     def test_health_check(self):
         """Test basic health endpoints"""
         print("\n=== HEALTH CHECK TESTS ===")
@@ -72,7 +104,15 @@ class MadinahToursAPITester:
             "health",
             200
         )
-        
+
+        # Test readiness endpoint
+        success, _ = self.run_test(
+            "Readiness Check",
+            "GET",
+            "ready",
+            200
+        )
+
         return success
 
     def test_sites_endpoints(self):
@@ -101,6 +141,17 @@ class MadinahToursAPITester:
                         200
                     )
         
+        # Test slot availability for the booking test site
+        success, availability = self.run_test(
+            "Get Site Availability",
+            "GET",
+            "sites/1/availability",
+            200
+        )
+        
+        if success and availability:
+            print(f"   Found {len(availability.get('slots', []))} slots")
+        
         return success
 
     def test_booking_creation(self):
@@ -158,6 +209,69 @@ class MadinahToursAPITester:
             data=payment_booking_data
         )
         
+        # Test bulk creation with one invalid item
+        invalid_booking_data = booking_data.copy()
+        invalid_booking_data["group_size"] = 50
+        success, bulk_response = self.run_test(
+            "Create Bulk Bookings",
+            "POST",
+            "bookings/bulk",
+            200,
+            data=[booking_data, invalid_booking_data]
+        )
+        if success and bulk_response:
+            print(f"   Created {bulk_response.get('created')}, invalid {bulk_response.get('invalid')}")
+            success = self.check_counts("Bulk Booking Counts", bulk_response, {"created": 1, "invalid": 1})
+        
+        return success
+
+    def test_idempotent_booking(self):
+        """Test Idempotency-Key replay, reuse with a different body, and release after a failure"""
+        print("\n=== IDEMPOTENT BOOKING TESTS ===")
+
+        # A far-off slot of its own, so reruns and the other tests do not share it
+        slot_date = (datetime.now() + timedelta(days=random.randint(200, 360))).strftime('%Y-%m-%d')
+        booking_data = {
+            "name": "Test User",
+            "email": "idempotency@example.com",
+            "phone": "+1234567890",
+            "site_id": 1,
+            "site_name": "Quba Mosque",
+            "group_size": 10,
+            "date": slot_date,
+            "time": "16:00",
+            "total_price": 1200.0,
+            "booking_type": "contact"
+        }
+        key = {"Idempotency-Key": f"backend-test-{uuid.uuid4().hex}"}
+
+        success, first = self.run_test(
+            "Create Booking with Idempotency-Key", "POST", "bookings", 200, data=booking_data, extra_headers=key
+        )
+        success, replay = self.run_test(
+            "Replay Booking with Same Key", "POST", "bookings", 200, data=booking_data, extra_headers=key
+        )
+        if success:
+            replayed = {"Idempotent-Replayed": self.last_response.headers.get("Idempotent-Replayed"), "id": replay.get("id")}
+            success = self.check_counts("Replayed Booking", replayed, {"Idempotent-Replayed": "true", "id": first.get("id")})
+
+        changed_data = {**booking_data, "group_size": 9}
+        success, _ = self.run_test(
+            "Reject Same Key with Different Body", "POST", "bookings", 422, data=changed_data, extra_headers=key
+        )
+
+        # Fill the slot (capacity 40, the first booking holds 10), then fail a request with a new key:
+        # the key is released, so the same key can be used again for another request
+        for _ in range(3):
+            self.run_test("Fill Slot", "POST", "bookings", 200, data=booking_data)
+        key = {"Idempotency-Key": f"backend-test-{uuid.uuid4().hex}"}
+        success, _ = self.run_test(
+            "Fail Booking with Idempotency-Key", "POST", "bookings", 409, data=booking_data, extra_headers=key
+        )
+        success, _ = self.run_test(
+            "Reuse Key after Failure", "POST", "bookings", 200, data={**booking_data, "time": "14:00"}, extra_headers=key
+        )
+
         return success
 
     def test_booking_status_update(self):
@@ -175,6 +289,28 @@ class MadinahToursAPITester:
             200,
             params={"status": "confirmed"}
         )
+
+        # Confirmed bookings cannot go back to pending
+        success, _ = self.run_test(
+            "Reject Disallowed Status Transition",
+            "PUT",
+            f"bookings/{self.booking_id}/status",
+            409,
+            params={"status": "pending"}
+        )
+
+        # ...so in a bulk update this one is skipped
+        success, bulk_response = self.run_test(
+            "Bulk Update Booking Status",
+            "PATCH",
+            "bookings/status",
+            200,
+            data={"status": "pending", "ids": [self.booking_id]}
+        )
+        if success:
+            success = self.check_counts(
+                "Bulk Status Counts", bulk_response, {"matched": 0, "modified": 0, "skipped": 1, "not_found": 0}
+            )
         
         return success
 
@@ -280,6 +416,46 @@ class MadinahToursAPITester:
             params={"user_email": "test@example.com"}
         )
         
+        # Test keyset pagination with a field projection: two pages, no repeats, newest first
+        success, first_page = self.run_test(
+            "Get Bookings Page",
+            "GET",
+            "bookings",
+            200,
+            params={"limit": 2, "fields": "status,site_name"}
+        )
+        next_cursor = self.last_response.headers.get("X-Next-Cursor") if success else None
+        if next_cursor:
+            success, second_page = self.run_test(
+                "Get Next Bookings Page",
+                "GET",
+                "bookings",
+                200,
+                params={"limit": 2, "fields": "status,site_name", "cursor": next_cursor}
+            )
+            if success:
+                success = self.check_page_order("Bookings Page Order", first_page + second_page)
+
+        # Test that a malformed cursor is rejected
+        malformed_cursor = base64.urlsafe_b64encode(b'[1,"x"]').decode().rstrip("=")
+        for cursor in ("not-a-cursor", malformed_cursor):
+            success, _ = self.run_test(
+                "Reject Malformed Cursor",
+                "GET",
+                "bookings",
+                400,
+                params={"cursor": cursor}
+            )
+        
+        # Test NDJSON export
+        success, _ = self.run_test(
+            "Export Bookings",
+            "GET",
+            "bookings/export",
+            200,
+            params={"user_email": "test@example.com"}
+        )
+        
         return success
 
 def main():
@@ -293,6 +469,7 @@ def main():
         tester.test_health_check,
         tester.test_sites_endpoints,
         tester.test_booking_creation,
+        tester.test_idempotent_booking,
         tester.test_booking_status_update,
         tester.test_payment_endpoints,
         tester.test_user_endpoints,
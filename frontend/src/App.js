@@ -169,10 +169,70 @@ const HomePage = () => {
     const urlParams = new URLSearchParams(window.location.search);
     const sessionId = urlParams.get('session_id');
     if (sessionId) {
-      checkPaymentStatus(sessionId);
+      return watchPaymentStatus(sessionId);
     }
   }, []);
 
+  const handlePaymentUpdate = (paymentState) => {
+    if (paymentState === 'paid') {
+      setPaymentStatus('success');
+      toast.success('Payment successful! Your tour booking is confirmed.');
+      // Clear URL parameters
+      window.history.replaceState({}, document.title, window.location.pathname);
+      return true;
+    } else if (paymentState === 'expired') {
+      setPaymentStatus('expired');
+      toast.error('Payment session expired. Please try again.');
+      return true;
+    } else if (paymentState === 'failed') {
+      setPaymentStatus('failed');
+      toast.error('Payment failed. Please try again.');
+      return true;
+    }
+    return false;
+  };
+
+  // Listen for payment status pushed by the server; fall back to polling if the stream fails
+  const watchPaymentStatus = (sessionId) => {
+    if (typeof EventSource === 'undefined') {
+      checkPaymentStatus(sessionId);
+      return undefined;
+    }
+
+    const events = new EventSource(`${API}/payments/checkout/events/${sessionId}`);
+    let received = false;
+    let finished = false;
+
+    events.addEventListener('status', (event) => {
+      const data = JSON.parse(event.data);
+      if (data.error) {
+        finished = true;
+        events.close();
+        checkPaymentStatus(sessionId);
+        return;
+      }
+      if (handlePaymentUpdate(data.payment_status)) {
+        finished = true;
+        events.close();
+      } else if (!received) {
+        setPaymentStatus('processing');
+        toast.info('Payment is being processed...');
+      }
+      received = true;
+    });
+
+    events.onerror = () => {
+      // Stream dropped before a final status: fall back to polling
+      events.close();
+      if (!finished) {
+        finished = true;
+        checkPaymentStatus(sessionId);
+      }
+    };
+
+    return () => events.close();
+  };
+
   const checkPaymentStatus = async (sessionId, attempts = 0) => {
     const maxAttempts = 5;
     const pollInterval = 2000; // 2 seconds
@@ -186,15 +246,7 @@ const HomePage = () => {
     try {
       const response = await axios.get(`${API}/payments/checkout/status/${sessionId}`);
       
-      if (response.data.payment_status === 'paid') {
-        setPaymentStatus('success');
-        toast.success('Payment successful! Your tour booking is confirmed.');
-        // Clear URL parameters
-        window.history.replaceState({}, document.title, window.location.pathname);
-        return;
-      } else if (response.data.status === 'expired') {
-        setPaymentStatus('expired');
-        toast.error('Payment session expired. Please try again.');
+      if (handlePaymentUpdate(response.data.status === 'expired' ? 'expired' : response.data.payment_status)) {
         return;
       }
 
@@ -441,7 +493,7 @@ Please contact the customer to confirm their booking.`;
               <div className="flex items-center space-x-3">
                 {paymentStatus === 'success' && <div className="w-4 h-4 bg-green-500 rounded-full"></div>}
                 {paymentStatus === 'processing' && <div className="w-4 h-4 bg-amber-500 rounded-full animate-pulse"></div>}
-                {(paymentStatus === 'error' || paymentStatus === 'expired' || paymentStatus === 'timeout') && 
+                {(paymentStatus === 'error' || paymentStatus === 'expired' || paymentStatus === 'failed' || paymentStatus === 'timeout') && 
                   <div className="w-4 h-4 bg-red-500 rounded-full"></div>}
                 <div>
                   <p className="font-medium">
@@ -449,12 +501,13 @@ Please contact the customer to confirm their booking.`;
                     {paymentStatus === 'processing' && 'Processing Payment...'}
                     {paymentStatus === 'error' && 'Payment Error'}
                     {paymentStatus === 'expired' && 'Payment Expired'}
+                    {paymentStatus === 'failed' && 'Payment Failed'}
                     {paymentStatus === 'timeout' && 'Payment Timeout'}
                   </p>
                   <p className="text-sm text-gray-600">
                     {paymentStatus === 'success' && 'Your booking has been confirmed.'}
                     {paymentStatus === 'processing' && 'Please wait while we process your payment.'}
-                    {(paymentStatus === 'error' || paymentStatus === 'expired' || paymentStatus === 'timeout') && 
+                    {(paymentStatus === 'error' || paymentStatus === 'expired' || paymentStatus === 'failed' || paymentStatus === 'timeout') && 
                       'Please try booking again or contact support.'}
                   </p>
                 </div>
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Load tests for the Madinah Ziyarat backend
+Runs server.app in-process over httpx's ASGI transport, against an in-memory Mongo
+(mongomock-motor) or a local mongod, with StripeCheckout and its request model replaced by stubs
+
+Each workload runs `concurrency` clients in a closed loop for --duration seconds,
+all workloads at the same time. Per endpoint it reports requests per second and
+p50/p95/p99 latency, and writes everything as JSON for comparison between releases.
+
+Usage: python load_test.py [workload[=concurrency] ...] [--duration 10] [--mongo-url mongodb://localhost:27017]
+                           [--pool-size 100] [--no-isolation]
+                           [--output load_test_results.json] [--compare previous.json]
+Workloads: catalog, bookings, status, webhooks, analytics (default: all of them)
+
+The analytics workload runs the live aggregation. To see what the analytics pool, read
+preferences and Mongo deadlines buy, run against a mongod with a small --pool-size, once
+as is and once with --no-isolation, and --compare the two (tail latency of the other routes).
+Server settings come from the environment, e.g. BOOKING_WRITE_BUFFER=1 python load_test.py bookings=200
+shows how booking throughput scales with concurrency once inserts are coalesced.
+
+Latencies include time spent waiting for the event loop the server shares with the
+clients, so compare runs made with the same workloads and concurrency. With the
+in-memory Mongo, database time is not representative; use --mongo-url for that.
+The database named by LOADTEST_DB_NAME (default madinah_loadtest) is dropped first.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+
+DEFAULT_CONCURRENCY = {"catalog": 20, "bookings": 10, "status": 20, "webhooks": 5, "analytics": 5}
+
+# Set in load_server(), once the Mongo backend is chosen
+server = None
+latency_summary = None
+sample_site_documents = None
+
+
+def load_server(mongo_url, pool_size=None, isolation=True):
+    """Import server.py against the chosen Mongo; must run before anything imports server"""
+    global server, latency_summary, sample_site_documents
+    os.environ["MONGO_URL"] = mongo_url or "mongodb://localhost:27017"
+    if pool_size:
+        os.environ["MONGO_MAX_POOL_SIZE"] = str(pool_size)
+    if not isolation or not mongo_url:
+        # One pool for everything, primary reads and no deadlines. mongomock needs this too:
+        # each of its clients is a separate store and it has no read preferences
+        os.environ["ANALYTICS_MAX_POOL_SIZE"] = "0"
+        os.environ["CATALOG_READ_PREFERENCE"] = os.environ["ANALYTICS_READ_PREFERENCE"] = "primary"
+    if not isolation:
+        os.environ["MONGO_REQUEST_TIMEOUT"] = "0"
+    os.environ["DB_NAME"] = os.environ.get("LOADTEST_DB_NAME", "madinah_loadtest")
+    os.environ.setdefault("STRIPE_API_KEY", "sk_test_loadtest")
+    # Fill slots freely: this measures request cost, not capacity rejections
+    os.environ.setdefault("SLOT_DEFAULT_CAPACITY", "1000000")
+    if not mongo_url:
+        try:
+            import mongomock_motor
+        except ImportError:
+            sys.exit("mongomock-motor is not installed; pip install mongomock-motor or pass --mongo-url")
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+        # mongomock has no replica set, so no transactions or change streams
+        os.environ.setdefault("PAYMENT_CONFIRMATION_MODE", "outbox")
+    sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+    import server as server_module
+    import backend_benchmark
+    server = server_module
+    latency_summary = backend_benchmark.latency_summary
+    sample_site_documents = backend_benchmark.sample_site_documents
+
+
+class StubStripeCheckout:
+    """Stands in for emergentintegrations' StripeCheckout: no network, fixed latency per call"""
+    latency = 0.0
+    sessions = {}
+
+    def __init__(self, api_key, webhook_url=""):
+        self.api_key = api_key
+        self.webhook_url = webhook_url
+
+    async def create_checkout_session(self, checkout_request):
+        await asyncio.sleep(self.latency)
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        self.sessions[session_id] = "unpaid"
+        return server.CheckoutSessionResponse(url=f"https://checkout.stripe.test/pay/{session_id}", session_id=session_id)
+
+    async def get_checkout_status(self, session_id):
+        await asyncio.sleep(self.latency)
+        payment_status = self.sessions.get(session_id, "unpaid")
+        return server.CheckoutStatusResponse(
+            status="complete" if payment_status == "paid" else "open",
+            payment_status=payment_status,
+            amount_total=24000,
+            currency="usd",
+            metadata={}
+        )
+
+    async def handle_webhook(self, body, signature):
+        # Accepts any signature; the event body is shaped like Stripe's
+        event = json.loads(body)
+        session = event["data"]["object"]
+        if session.get("payment_status") == "paid":
+            self.sessions[session["id"]] = "paid"
+        return SimpleNamespace(
+            event_type=event["type"],
+            event_id=event["id"],
+            session_id=session["id"],
+            payment_status=session.get("payment_status"),
+            metadata={}
+        )
+
+
+def stub_stripe(latency=0.0):
+    """Serve the server's Stripe integration module from the stub, so emergentintegrations is not needed"""
+    StubStripeCheckout.latency = latency
+    # The route builds its CheckoutSessionRequest from the module too
+    server.stripe_checkout_module = lambda: SimpleNamespace(
+        StripeCheckout=StubStripeCheckout, CheckoutSessionRequest=SimpleNamespace
+    )
+
+
+def booking_payload(site_id=None):
+    slot_date = date.today() + timedelta(days=random.randrange(1, 365))
+    group_size = random.randint(1, 4)
+    return {
+        "name": "Load Test Traveller",
+        "email": f"traveller{random.randrange(1000)}@example.com",
+        "phone": "+966500000000",
+        "site_id": site_id or random.randint(1, 12),
+        "site_name": "Tour of Masjid Quba",
+        "group_size": group_size,
+        "date": slot_date.isoformat(),
+        "time": random.choice(server.SLOT_TIMES),
+        "special_requests": None,
+        "total_price": 120.0 * group_size,
+        "booking_type": "payment",
+    }
+
+
+def webhook_event(session_id):
+    return json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": session_id, "payment_status": random.choice(["paid", "unpaid"])}},
+    })
+
+
+class LoadTest:
+    def __init__(self, concurrency, duration, sessions):
+        self.concurrency = concurrency
+        self.duration = duration
+        self.session_count = sessions
+        self.session_ids = []
+        # endpoint -> latencies in seconds, endpoint -> status code counts
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    async def seed(self, client):
+        """Fresh database with the catalog and checkout sessions for the status and webhook workloads"""
+        await server.client.drop_database(server.db.name)
+        documents = sample_site_documents()
+        for document in documents:
+            document["created_at"] = datetime(2024, 9, 1, 8, 0, tzinfo=timezone.utc)
+        await server.db.historical_sites.insert_many(documents)
+        server.catalog_cache.invalidate()
+        for _ in range(self.session_count):
+            booking = (await client.post("/api/bookings", json=booking_payload())).json()
+            checkout = await client.post("/api/payments/checkout/session", json={
+                "booking_id": booking["id"],
+                "success_url": "https://madinah.test/success",
+                "cancel_url": "https://madinah.test/cancel",
+            })
+            self.session_ids.append(checkout.json()["session_id"])
+
+    async def request(self, client, endpoint, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        self.samples[endpoint].append(time.perf_counter() - start)
+        self.statuses[endpoint][str(status)] += 1
+
+    async def catalog(self, client):
+        await self.request(client, "GET /api/sites", "GET", "/api/sites")
+
+    async def bookings(self, client):
+        await self.request(client, "POST /api/bookings", "POST", "/api/bookings", json=booking_payload())
+
+    async def status(self, client):
+        session_id = random.choice(self.session_ids)
+        await self.request(client, "GET /api/payments/checkout/status/{session_id}", "GET",
+                           f"/api/payments/checkout/status/{session_id}")
+
+    async def webhooks(self, client):
+        await self.request(client, "POST /api/webhook/stripe", "POST", "/api/webhook/stripe",
+                           content=webhook_event(random.choice(self.session_ids)),
+                           headers={"Stripe-Signature": "t=0,v1=loadtest"})
+
+    async def analytics(self, client):
+        await self.request(client, "GET /api/analytics/bookings?live=true", "GET", "/api/analytics/bookings",
+                           params={"live": "true"})
+
+    async def worker(self, client, workload, deadline):
+        step = getattr(self, workload)
+        while time.perf_counter() < deadline:
+            await step(client)
+            # A request served from memory never suspends, which would let one client run alone until the deadline
+            await asyncio.sleep(0)
+
+    async def run(self):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            async with server.app.router.lifespan_context(server.app):
+                await self.seed(client)
+                deadline = time.perf_counter() + self.duration
+                await asyncio.gather(*(
+                    self.worker(client, workload, deadline)
+                    for workload, concurrency in self.concurrency.items()
+                    for _ in range(concurrency)
+                ))
+
+    def report(self):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            statuses = self.statuses[endpoint]
+            errors = sum(count for status, count in statuses.items() if not status.startswith(("2", "3")))
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "rps": len(samples) / self.duration,
+                **latency_summary(samples),
+                "status_codes": dict(statuses),
+            }
+        return endpoints
+
+
+def print_report(endpoints, previous=None):
+    print(f"   {'endpoint':<50} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for endpoint, result in endpoints.items():
+        line = (f"   {endpoint:<50} {result['rps']:8.1f} {result['p50']:8.2f} {result['p95']:8.2f} "
+                f"{result['p99']:8.2f} {result['errors']:7d}")
+        before = (previous or {}).get(endpoint)
+        if before:
+            line += f"   rps {result['rps'] / before['rps'] - 1:+.0%}, p95 {result['p95'] / before['p95'] - 1:+.0%}"
+        print(line)
+
+
+def parse_workloads(parser, values):
+    concurrency = {}
+    for value in values or DEFAULT_CONCURRENCY:
+        name, _, count = value.partition("=")
+        if name not in DEFAULT_CONCURRENCY:
+            parser.error(f"unknown workload {name!r}; available: {', '.join(DEFAULT_CONCURRENCY)}")
+        try:
+            concurrency[name] = int(count) if count else DEFAULT_CONCURRENCY[name]
+        except ValueError:
+            parser.error(f"invalid concurrency in {value!r}")
+    return concurrency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("workloads", nargs="*", metavar="workload[=concurrency]")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load (default: 10)")
+    parser.add_argument("--sessions", type=int, default=50, help="checkout sessions to poll and complete (default: 50)")
+    parser.add_argument("--stripe-latency-ms", type=float, default=50.0, help="stub Stripe delay per call (default: 50)")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-memory stand-in")
+    parser.add_argument("--pool-size", type=int, help="MONGO_MAX_POOL_SIZE for the run (default: the server's)")
+    parser.add_argument("--no-isolation", dest="isolation", action="store_false",
+                        help="share one pool, read the primary and disable Mongo deadlines")
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--compare", help="earlier results file to show changes against")
+    parser.add_argument("--log-level", default="WARNING", help="server log level during the run (default: WARNING)")
+    args = parser.parse_args()
+    concurrency = parse_workloads(parser, args.workloads)
+
+    load_server(args.mongo_url, args.pool_size, args.isolation)
+    logging.getLogger().setLevel(args.log_level.upper())
+    stub_stripe(args.stripe_latency_ms / 1000)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["endpoints"]
+
+    print("🚀 Madinah Ziyarat backend load test")
+    print("=" * 60)
+    print(f"   Mongo: {args.mongo_url or 'in-memory (mongomock-motor)'}, "
+          f"stub Stripe latency {args.stripe_latency_ms:.0f} ms, {args.duration:.0f} s, "
+          f"isolation {'on' if args.isolation else 'off'}")
+    print(f"   Workloads: {', '.join(f'{name}={count}' for name, count in concurrency.items())}")
+
+    load_test = LoadTest(concurrency, args.duration, args.sessions)
+    started_at = datetime.now(timezone.utc)
+    asyncio.run(load_test.run())
+    endpoints = load_test.report()
+    print_report(endpoints, previous)
+
+    results = {
+        "started_at": started_at.isoformat(),
+        "duration": args.duration,
+        "mongo": "mongod" if args.mongo_url else "mongomock",
+        "stripe_latency_ms": args.stripe_latency_ms,
+        "pool_size": args.pool_size,
+        "isolation": args.isolation,
+        "workloads": concurrency,
+        "endpoints": endpoints,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"   Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Consistency checks for payment confirmation
+Runs server.app in-process, like load_test.py, against an in-memory Mongo (mongomock-motor)
+or a local mongod, with Stripe stubbed. Each case starts from an empty database and
+checks the booking, the analytics counters and the slot seats afterwards:
+
+  duplicate_webhook_and_poll    the same paid event delivered twice, a second paid event and
+                                a status poll, all at once: the booking is confirmed once
+  late_event_after_paid         an "unpaid" event arriving after "paid" changes nothing
+  recovery_confirms_pending     outbox recovery confirms a paid booking left pending
+  recovery_keeps_operator_cancel  outbox recovery leaves a booking an operator cancelled alone
+
+Usage: python payment_check.py [case ...] [--mongo-url mongodb://localhost:27017]
+The database named by LOADTEST_DB_NAME (default madinah_loadtest) is dropped before each case.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import httpx
+
+import load_test
+from load_test import StubStripeCheckout, load_server, stub_stripe
+
+GROUP_SIZE = 3
+
+
+class Failed(Exception):
+    pass
+
+
+def expect(label, actual, expected):
+    if actual != expected:
+        raise Failed(f"{label}: expected {expected!r}, got {actual!r}")
+
+
+def booking_payload():
+    return {
+        "name": "Payment Check Traveller",
+        "email": "payments@example.com",
+        "phone": "+966500000000",
+        "site_id": 1,
+        "site_name": "Tour of Masjid Quba",
+        "group_size": GROUP_SIZE,
+        "date": (date.today() + timedelta(days=7)).isoformat(),
+        "time": load_test.server.SLOT_TIMES[0],
+        "special_requests": None,
+        "total_price": 360.0,
+        "booking_type": "payment",
+    }
+
+
+def webhook_event(session_id, payment_status, event_id=None):
+    return json.dumps({
+        "id": event_id or f"evt_{uuid.uuid4().hex}",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": session_id, "payment_status": payment_status}},
+    })
+
+
+class PaymentCheck:
+    def __init__(self, client):
+        self.client = client
+        self.server = load_test.server
+
+    async def reset(self):
+        await self.server.client.drop_database(self.server.db.name)
+        StubStripeCheckout.sessions.clear()
+
+    async def checkout(self):
+        """A pending booking with an open checkout session; returns (booking_id, session_id)"""
+        booking = (await self.client.post("/api/bookings", json=booking_payload())).json()
+        checkout = await self.client.post("/api/payments/checkout/session", json={
+            "booking_id": booking["id"],
+            "success_url": "https://madinah.test/success",
+            "cancel_url": "https://madinah.test/cancel",
+        })
+        expect("checkout session", checkout.status_code, 200)
+        return booking["id"], checkout.json()["session_id"]
+
+    async def send_webhook(self, body):
+        response = await self.client.post("/api/webhook/stripe", content=body, headers={"Stripe-Signature": "t=0,v1=check"})
+        expect("webhook", response.status_code, 200)
+
+    async def drain_webhooks(self, timeout=5.0):
+        """Wait until the inbox workers have applied every stored event"""
+        deadline = time.monotonic() + timeout
+        while await self.server.db.webhook_inbox.count_documents({"status": {"$ne": "done"}}):
+            if time.monotonic() > deadline:
+                raise Failed("webhook events were not applied in time")
+            await asyncio.sleep(0.05)
+
+    async def expect_state(self, booking_id, session_id, status, payment_status, booked):
+        booking = await self.server.db.bookings.find_one({"id": booking_id})
+        expect("booking status", booking["status"], status)
+        payment = await self.server.db.payment_transactions.find_one({"session_id": session_id})
+        expect("payment status", payment["payment_status"], payment_status)
+        counters = await self.server.db.booking_counters.find_one({"_id": self.server.BOOKING_COUNTERS_ID}) or {}
+        expected_counters = {"total": 1, "pending": 0, "confirmed": 0, "cancelled": 0, status: 1}
+        expect("counters", {key: counters.get(key, 0) for key in expected_counters}, expected_counters)
+        payload = booking_payload()
+        slot = await self.server.db.slot_occupancy.find_one(
+            {"_id": self.server.slot_id(payload["site_id"], payload["date"], payload["time"])}
+        )
+        expect("booked seats", slot["booked"] if slot else 0, booked)
+
+    async def duplicate_webhook_and_poll(self):
+        booking_id, session_id = await self.checkout()
+        StubStripeCheckout.sessions[session_id] = "paid"
+        duplicate = webhook_event(session_id, "paid")
+        poll = self.client.get(f"/api/payments/checkout/status/{session_id}")
+        results = await asyncio.gather(
+            self.send_webhook(duplicate), self.send_webhook(duplicate),
+            self.send_webhook(webhook_event(session_id, "paid")), poll
+        )
+        expect("status poll", results[-1].json()["payment_status"], "paid")
+        await self.drain_webhooks()
+        expect("stored events", await self.server.db.webhook_inbox.count_documents({}), 2)
+        await self.expect_state(booking_id, session_id, "confirmed", "paid", GROUP_SIZE)
+
+    async def late_event_after_paid(self):
+        booking_id, session_id = await self.checkout()
+        StubStripeCheckout.sessions[session_id] = "paid"
+        await self.send_webhook(webhook_event(session_id, "paid"))
+        await self.drain_webhooks()
+        await self.send_webhook(webhook_event(session_id, "unpaid"))
+        await self.drain_webhooks()
+        await self.expect_state(booking_id, session_id, "confirmed", "paid", GROUP_SIZE)
+
+    async def leave_confirmation_pending(self, session_id):
+        """What a crash between the payment write and the booking write leaves behind"""
+        await self.server.db.payment_transactions.update_one({"session_id": session_id}, {"$set": {
+            "payment_status": "paid", "confirmation_pending": True,
+            "updated_at": datetime.now(timezone.utc) - timedelta(days=1),
+        }})
+
+    async def recovery_confirms_pending(self):
+        booking_id, session_id = await self.checkout()
+        await self.leave_confirmation_pending(session_id)
+        expect("recovered", await self.server.recover_payment_confirmations(), 1)
+        expect("recovered again", await self.server.recover_payment_confirmations(), 0)
+        await self.expect_state(booking_id, session_id, "confirmed", "paid", GROUP_SIZE)
+
+    async def recovery_keeps_operator_cancel(self):
+        booking_id, session_id = await self.checkout()
+        StubStripeCheckout.sessions[session_id] = "paid"
+        await self.send_webhook(webhook_event(session_id, "paid"))
+        await self.drain_webhooks()
+        response = await self.client.put(f"/api/bookings/{booking_id}/status", params={"status": "cancelled"})
+        expect("operator cancel", response.status_code, 200)
+        await self.leave_confirmation_pending(session_id)
+        await self.server.recover_payment_confirmations()
+        await self.expect_state(booking_id, session_id, "cancelled", "paid", 0)
+
+
+CASES = ["duplicate_webhook_and_poll", "late_event_after_paid", "recovery_confirms_pending", "recovery_keeps_operator_cancel"]
+
+
+async def run(cases):
+    failures = 0
+    server = load_test.server
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://paymentcheck") as client:
+        async with server.app.router.lifespan_context(server.app):
+            check = PaymentCheck(client)
+            for case in cases:
+                await check.reset()
+                try:
+                    await getattr(check, case)()
+                    print(f"✅ {case}")
+                except Failed as e:
+                    failures += 1
+                    print(f"❌ {case}: {e}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cases", nargs="*", metavar="case", help=f"default: {' '.join(CASES)}")
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-memory stand-in")
+    parser.add_argument("--log-level", default="WARNING", help="server log level during the run (default: WARNING)")
+    args = parser.parse_args()
+    unknown = [case for case in args.cases if case not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    load_server(args.mongo_url)
+    logging.getLogger().setLevel(args.log_level.upper())
+    stub_stripe()
+
+    print("🚀 Madinah Ziyarat payment confirmation checks")
+    print("=" * 60)
+    failures = asyncio.run(run(args.cases or CASES))
+    print("=" * 60)
+    print("🎉 All checks passed!" if not failures else f"⚠️  {failures} check(s) failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())